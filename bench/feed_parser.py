@@ -0,0 +1,116 @@
+"""Micro-benchmark: streaming feed parser (main.parse_feed) vs. the old bs4 path.
+
+Đo CPU time và peak memory (tracemalloc) khi parse các feed lớn thực tế.
+
+    python bench/feed_parser.py                       # tải cointelegraph + vnexpress
+    python bench/feed_parser.py --file a.xml --file b.rss -n 20 --limit 5
+
+Nếu không tải được feed nào (offline) sẽ dùng một feed RSS tổng hợp cỡ lớn.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import urllib.request
+import warnings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+from bs4 import BeautifulSoup, FeatureNotFound, XMLParsedAsHTMLWarning  # noqa: E402
+
+import main  # noqa: E402
+
+warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+
+DEFAULT_URLS = [
+    "https://cointelegraph.com/rss",
+    "https://vnexpress.net/rss/so-hoa/tin-tuc.rss",
+]
+
+
+def bs4_path(content: bytes, src: str, limit: int):
+    """Bản sao đường parse cũ: DOM đầy đủ "xml", fallback "html.parser"."""
+    try:
+        soup = BeautifulSoup(content, "xml")
+        items = soup.find_all("item")
+    except FeatureNotFound:  # lxml chưa cài -> đường cũ chỉ còn html.parser
+        items = []
+    if not items:
+        soup = BeautifulSoup(content, "html.parser")
+        items = soup.find_all("item")
+    out = []
+    for i in items[:limit]:
+        title = getattr(i, "title", "").text.strip() if getattr(i, "title", None) else "Không có tiêu đề"
+        if i.find("link") and getattr(i.find("link"), "text", "").strip().startswith("http"):
+            link = i.find("link").text.strip()
+        elif i.find("guid") and "http" in getattr(i.find("guid"), "text", ""):
+            link = i.find("guid").text.strip()
+        else:
+            link = src
+        out.append((title, link))
+    return out
+
+
+def stream_path(content: bytes, src: str, limit: int):
+    return main.parse_feed(content, src, limit)
+
+
+def synthetic_feed(n_items: int = 300) -> bytes:
+    body = "".join(
+        f"<item><title>Bitcoin tăng giá lần {i}</title><link>https://example.com/{i}</link>"
+        f"<guid>https://example.com/{i}</guid><pubDate>Mon, 01 Jan 2024 00:00:00 GMT</pubDate>"
+        f"<description><![CDATA[{'<p>Lorem ipsum dolor sit amet.</p>' * 40}]]></description></item>"
+        for i in range(n_items)
+    )
+    return f'<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>synthetic</title>{body}</channel></rss>'.encode()
+
+
+def measure(fn, content: bytes, src: str, limit: int, repeat: int):
+    fn(content, src, limit)  # warm-up
+    cpu0 = time.process_time()
+    for _ in range(repeat):
+        fn(content, src, limit)
+    cpu = (time.process_time() - cpu0) / repeat
+    tracemalloc.start()
+    fn(content, src, limit)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu, peak
+
+
+def load_inputs(args):
+    inputs = []
+    for path in args.file:
+        with open(path, "rb") as f:
+            inputs.append((path, f.read()))
+    for url in ([] if args.file else args.url or DEFAULT_URLS):
+        try:
+            req = urllib.request.Request(url, headers=main.HTTP_HEADERS | {"Accept-Encoding": "identity"})
+            with urllib.request.urlopen(req, timeout=15) as r:
+                inputs.append((url, r.read()))
+        except Exception as e:
+            print(f"! không tải được {url}: {e}", file=sys.stderr)
+    if not inputs:
+        inputs.append(("synthetic", synthetic_feed()))
+    return inputs
+
+
+def main_cli():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--url", action="append", default=[])
+    ap.add_argument("--file", action="append", default=[])
+    ap.add_argument("-n", "--repeat", type=int, default=10)
+    ap.add_argument("--limit", type=int, default=5, help="số bài cần lấy (mặc định 5 như /news)")
+    args = ap.parse_args()
+
+    print(f"{'feed':<48} {'KiB':>7} {'parser':<7} {'cpu ms':>9} {'peak KiB':>9}")
+    for src, content in load_inputs(args):
+        for name, fn in (("bs4", bs4_path), ("stream", stream_path)):
+            cpu, peak = measure(fn, content, src, args.limit, args.repeat)
+            print(f"{src[:48]:<48} {len(content) / 1024:>7.0f} {name:<7} {cpu * 1000:>9.2f} {peak / 1024:>9.0f}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,318 @@
+"""Benchmark offline: chạy bot với các server giả trên localhost.
+
+Dựng một aiohttp server giả lập Telegram Bot API, CoinGecko (coins/list, search,
+simple/price, coins/markets, global), các RSS feed và endpoint completions của
+chatanywhere; mỗi loại có latency / jitter / tỉ lệ lỗi / kích thước payload riêng.
+Sau đó phát một luồng update tổng hợp qua application.process_update và in
+throughput + p50/p95/p99 theo từng lệnh, cuối cùng đo broadcast báo cáo ngày.
+
+    python bench/harness.py
+    python bench/harness.py --updates 2000 --concurrency 50 --cg-latency 0.2 --cg-error-rate 0.05
+    python bench/harness.py --cold --broadcast-users 500 --tg-error-rate 0.01
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+
+from aiohttp import web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+BOT_TOKEN = "123456:bench"
+BENCH_USERS = range(1000, 1100)   # user gửi lệnh
+MIX = [
+    ("/price", "/price btc", 30),
+    ("/price*", "/price btc eth sol bnb xrp", 10),
+    ("/top", "/top", 10),
+    ("/news", "/news", 15),
+    ("/report", "/report", 10),
+    ("/start", "/start", 10),
+    ("ai", "BTC là gì vậy?", 15),
+]
+
+
+@dataclass
+class Fake:
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+
+    async def delay(self) -> None:
+        d = self.latency + random.uniform(0, self.jitter)
+        if d > 0:
+            await asyncio.sleep(d)
+
+    def fail(self) -> bool:
+        return random.random() < self.error_rate
+
+
+class FakeUpstreams:
+    def __init__(self, args):
+        self.args = args
+        self.fake = {name: Fake(getattr(args, f"{name}_latency"), args.jitter, getattr(args, f"{name}_error_rate"))
+                     for name in ("tg", "cg", "rss", "ai")}
+        self.message_id = 0
+        self.counts = {"telegram": 0, "coingecko": 0, "rss": 0, "rss_304": 0, "ai": 0}
+        self.coins = [
+            {"id": "bitcoin", "symbol": "btc", "name": "Bitcoin"},
+            {"id": "ethereum", "symbol": "eth", "name": "Ethereum"},
+            {"id": "binancecoin", "symbol": "bnb", "name": "BNB"},
+            {"id": "solana", "symbol": "sol", "name": "Solana"},
+            {"id": "ripple", "symbol": "xrp", "name": "XRP"},
+        ] + [
+            {"id": f"coin-{i}", "symbol": f"c{i % 3000}", "name": f"Coin {i}"} for i in range(args.coins)
+        ]
+        self.coins_body = json.dumps(self.coins).encode()
+        self.feed_body = self._feed(args.feed_items, args.feed_desc)
+
+    @staticmethod
+    def _feed(n: int, desc: int) -> bytes:
+        items = "".join(
+            f"<item><title>Tin bench số {i}</title><link>https://bench.local/{i}</link>"
+            f"<guid>https://bench.local/{i}</guid><pubDate>Mon, 01 Jan 2024 00:00:00 GMT</pubDate>"
+            f"<description><![CDATA[{'x' * desc}]]></description></item>"
+            for i in range(n)
+        )
+        return f'<?xml version="1.0"?><rss version="2.0"><channel><title>bench</title>{items}</channel></rss>'.encode()
+
+    # ----- Telegram Bot API -----
+    async def telegram(self, request: web.Request) -> web.Response:
+        self.counts["telegram"] += 1
+        await self.fake["tg"].delay()
+        method = request.match_info["method"]
+        params = dict(await request.post()) if request.body_exists else {}
+        if request.content_type == "application/json":
+            params = await request.json()
+        if method in ("sendMessage", "editMessageText") and self.fake["tg"].fail():
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "girlhonghot",
+                      "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True}
+        elif method in ("sendMessage", "editMessageText"):
+            self.message_id += 1
+            chat_id = int(params.get("chat_id", 0))
+            result = {"message_id": self.message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+        elif method == "getChat":
+            result = {"id": int(params.get("chat_id", 0)), "type": "private", "first_name": "bench",
+                      "accent_color_id": 0, "max_reaction_count": 11}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # ----- CoinGecko -----
+    async def coingecko(self, request: web.Request) -> web.Response:
+        self.counts["coingecko"] += 1
+        await self.fake["cg"].delay()
+        if self.fake["cg"].fail():
+            return web.Response(status=random.choice((429, 500, 503)), headers={"Retry-After": "1"})
+        path, q = request.match_info["path"], request.query
+        if path == "coins/list":
+            return web.Response(body=self.coins_body, content_type="application/json")
+        if path == "simple/price":
+            ids = [i for i in q.get("ids", "").split(",") if i]
+            return web.json_response({i: {"usd": round(random.uniform(1, 70000), 2),
+                                          "usd_24h_change": random.uniform(-5, 5)} for i in ids})
+        if path == "coins/markets":
+            page, per_page = int(q.get("page", 1)), int(q.get("per_page", 100))
+            start = (page - 1) * per_page
+            return web.json_response([
+                {"id": c["id"], "symbol": c["symbol"], "name": c["name"], "market_cap_rank": start + i + 1,
+                 "current_price": 1.0, "price_change_percentage_24h": 0.0}
+                for i, c in enumerate(self.coins[start:start + per_page])
+            ])
+        if path == "global":
+            return web.json_response({"data": {"total_market_cap": {"usd": 2.5e12}, "total_volume": {"usd": 9e10},
+                                               "market_cap_percentage": {"btc": 54.2}}})
+        if path == "search":
+            query = q.get("query", "").lower()
+            return web.json_response({"coins": [dict(c, market_cap_rank=i + 1) for i, c in enumerate(self.coins[:50])
+                                                if c["symbol"] == query]})
+        return web.json_response({}, status=404)
+
+    # ----- RSS -----
+    async def rss(self, request: web.Request) -> web.Response:
+        self.counts["rss"] += 1
+        await self.fake["rss"].delay()
+        if self.fake["rss"].fail():
+            return web.Response(status=503)
+        if request.headers.get("If-None-Match") == '"bench"':
+            self.counts["rss_304"] += 1
+            return web.Response(status=304)
+        return web.Response(body=self.feed_body, content_type="application/rss+xml", headers={"ETag": '"bench"'})
+
+    # ----- chatanywhere completions (SSE) -----
+    async def ai(self, request: web.Request) -> web.StreamResponse:
+        self.counts["ai"] += 1
+        await self.fake["ai"].delay()
+        if self.fake["ai"].fail():
+            return web.Response(status=500)
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for i in range(self.args.ai_tokens):
+            chunk = {"choices": [{"delta": {"content": f"token{i} "}}]}
+            await resp.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.args.ai_token_delay:
+                await asyncio.sleep(self.args.ai_token_delay)
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.telegram)
+        app.router.add_get("/cg/{path:.*}", self.coingecko)
+        app.router.add_get("/rss/{i}", self.rss)
+        app.router.add_post("/ai/v1/chat/completions", self.ai)
+        return app
+
+
+def make_update(bot, update_id: int, uid: int, text: str):
+    from telegram import Update
+
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "bench"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": update_id, "message": message}, bot)
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args) -> None:
+    fakes = FakeUpstreams(args)
+    runner = web.AppRunner(fakes.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    workdir = tempfile.mkdtemp(prefix="ghh-bench-")
+    os.chdir(workdir)
+    users = {str(u): "bench" for u in list(BENCH_USERS) + list(range(10_000, 10_000 + args.broadcast_users))}
+    with open("config.json", "w", encoding="utf-8") as f:
+        json.dump({"users": users, "report_time": "03:33",
+                   "news_sources": [f"{base}/rss/{i}" for i in range(args.feeds)]}, f)
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": f"{base}/bot",
+        "COINGECKO_API": f"{base}/cg",
+        "CHATANYWHERE_API_URL": f"{base}/ai/v1/chat/completions",
+        "CHATANYWHERE_API_KEY": "bench",
+        "METRICS_PORT": "0",
+        "COINGECKO_RPM": str(args.cg_rpm),
+    })
+    logging.disable(logging.WARNING if args.quiet else logging.NOTSET)
+
+    import main
+
+    app = main.application
+    t0 = time.perf_counter()
+    await app.initialize()
+    await main.post_init(app)
+    if not args.cold:
+        await main.get_coin_index()
+        await main.fetch_all_feeds(main.load_config())
+    print(f"startup{' (cold)' if args.cold else ' (warm)'}: {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+    weights = [w for _, _, w in MIX]
+    latencies = {name: [] for name, _, _ in MIX}
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(args.updates):
+        name, text, _ = random.choices(MIX, weights)[0]
+        queue.put_nowait((i + 1, name, text))
+
+    async def client(uid: int) -> None:
+        while not queue.empty():
+            update_id, name, text = queue.get_nowait()
+            start = time.perf_counter()
+            await app.process_update(make_update(app.bot, update_id, uid, text))
+            latencies[name].append(time.perf_counter() - start)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client(BENCH_USERS[i % len(BENCH_USERS)]) for i in range(args.concurrency)))
+    wall = time.perf_counter() - t0
+
+    errors = main.METRICS.counters.get("bot_handler_errors_total", {})
+    print(f"\n{args.updates} update, concurrency {args.concurrency}: {wall:.2f}s, {args.updates / wall:.1f} update/s\n")
+    print(f"{'lệnh':<10}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for name, values in latencies.items():
+        if values:
+            print(f"{name:<10}{len(values):>6}{percentile(values, .5) * 1000:>10.1f}{percentile(values, .95) * 1000:>10.1f}"
+                  f"{percentile(values, .99) * 1000:>10.1f}{statistics.mean(values) * 1000:>10.1f}")
+    if errors:
+        print("handler errors:", {dict(k)["handler"]: int(v) for k, v in errors.items()})
+
+    if args.broadcast_users:
+        main.BROADCAST_RATE = args.broadcast_rate
+        msg, _ = await main.get_report()
+        t0 = time.perf_counter()
+        stats = await main.broadcast_report(app, msg)
+        wall = time.perf_counter() - t0
+        print(f"\nbroadcast: {stats['sent']} gửi / {stats['failed']} lỗi trong {wall:.2f}s "
+              f"({stats['sent'] / wall:.1f} tin/s, giới hạn {args.broadcast_rate}/s)")
+
+    print("\nupstream calls:", fakes.counts)
+    # post_shutdown huỷ các task nền giữa chừng request; fake server không cần log việc đó
+    logging.getLogger("aiohttp.server").setLevel(logging.CRITICAL)
+    await main.post_shutdown(app)
+    await app.shutdown()
+    await runner.cleanup()
+    os.chdir(ROOT)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def add_upstream_args(ap: argparse.ArgumentParser) -> None:
+    """Tham số của các fake upstream (dùng chung với startup.py)"""
+    ap.add_argument("--jitter", type=float, default=0.01, help="giây, jitter ngẫu nhiên cộng thêm cho mọi fake")
+    for name, latency in (("tg", 0.02), ("cg", 0.08), ("rss", 0.15), ("ai", 0.3)):
+        ap.add_argument(f"--{name}-latency", type=float, default=latency, help="giây")
+        ap.add_argument(f"--{name}-error-rate", type=float, default=0.0)
+    ap.add_argument("--coins", type=int, default=15000, help="kích thước coins/list")
+    ap.add_argument("--cg-rpm", type=int, default=600, help="ngân sách CoinGecko của bot trong bench")
+    ap.add_argument("--feeds", type=int, default=7)
+    ap.add_argument("--feed-items", type=int, default=50)
+    ap.add_argument("--feed-desc", type=int, default=2000, help="byte mô tả mỗi item")
+    ap.add_argument("--ai-tokens", type=int, default=80)
+    ap.add_argument("--ai-token-delay", type=float, default=0.005)
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--updates", type=int, default=500)
+    ap.add_argument("--concurrency", type=int, default=20)
+    ap.add_argument("--cold", action="store_true", help="không làm nóng coin index / feed trước khi đo")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--quiet", action="store_true", help="ẩn log WARNING trở xuống")
+    add_upstream_args(ap)
+    ap.add_argument("--broadcast-users", type=int, default=200)
+    ap.add_argument("--broadcast-rate", type=float, default=25)
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    random.seed(args.seed)
+    asyncio.run(run(args))
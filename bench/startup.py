@@ -0,0 +1,132 @@
+"""Benchmark khởi động: thời gian tới phản hồi đầu tiên qua nhiều lần restart.
+
+Dựng các fake upstream của harness.py rồi chạy bot --restarts lần liên tiếp, mỗi
+lần trong một process con mới nhưng cùng thư mục làm việc — lần đầu là cold start,
+các lần sau dùng snapshot cache ấm lần trước để lại. Mỗi lần đo (tính từ lúc tạo
+process): import xong, initialize + post_init xong, và lúc /start, /price, /news
+đầu tiên (gửi đồng thời) được trả lời.
+
+    python bench/startup.py
+    python bench/startup.py --restarts 5 --cg-latency 0.5 --rss-latency 1
+    python bench/startup.py --no-snapshots     # mọi lần đều cold
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# process con không import harness (kéo theo aiohttp) để không làm sai số đo import
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIRST_UPDATES = (("/start", "/start"), ("/price", "/price btc"), ("/news", "/news"))
+BENCH_UID = 1000
+
+
+async def child() -> None:
+    """Chạy trong process con: đo một lần khởi động rồi in kết quả dạng JSON"""
+    t0 = float(os.environ["BENCH_T0"])
+    marks = {"python": time.time() - t0}
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import main
+    from telegram import Update
+
+    marks["import"] = time.time() - t0
+    app = main.application
+    await app.initialize()
+    await main.post_init(app)
+    marks["ready"] = time.time() - t0
+
+    async def first(name: str, text: str, update_id: int) -> None:
+        chat = {"id": BENCH_UID, "type": "private"}
+        message = {
+            "message_id": update_id, "date": int(time.time()), "chat": chat, "text": text,
+            "from": {"id": BENCH_UID, "is_bot": False, "first_name": "bench"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        }
+        await app.process_update(Update.de_json({"update_id": update_id, "message": message}, app.bot))
+        marks[name] = time.time() - t0
+
+    await asyncio.gather(*(first(name, text, i + 1) for i, (name, text) in enumerate(FIRST_UPDATES)))
+    print("BENCH " + json.dumps(marks), flush=True)
+    # bot thật chạy tiếp: để các tác vụ nền làm mới và ghi snapshot
+    await asyncio.sleep(float(os.environ["BENCH_SETTLE"]))
+    await main.post_shutdown(app)
+    await app.shutdown()
+
+
+async def run(args) -> None:
+    from aiohttp import web
+    from harness import BOT_TOKEN, FakeUpstreams
+
+    fakes = FakeUpstreams(args)
+    runner = web.AppRunner(fakes.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    base = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    workdir = tempfile.mkdtemp(prefix="ghh-startup-")
+    with open(os.path.join(workdir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({"users": {str(BENCH_UID): "bench"}, "report_time": "03:33",
+                   "news_sources": [f"{base}/rss/{i}" for i in range(args.feeds)]}, f)
+    env = dict(os.environ,
+               BOT_TOKEN=BOT_TOKEN,
+               TELEGRAM_API_URL=f"{base}/bot",
+               COINGECKO_API=f"{base}/cg",
+               CHATANYWHERE_API_URL=f"{base}/ai/v1/chat/completions",
+               CHATANYWHERE_API_KEY="bench",
+               METRICS_PORT=str(args.metrics_port),
+               COINGECKO_RPM=str(args.cg_rpm),
+               BENCH_SETTLE=str(args.settle))
+
+    rows = []
+    for i in range(args.restarts):
+        if args.no_snapshots:
+            shutil.rmtree(os.path.join(workdir, "snapshots"), ignore_errors=True)
+        env["BENCH_T0"] = repr(time.time())
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "--child",
+            cwd=workdir, env=env, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate()
+        lines = [ln for ln in out.decode().splitlines() if ln.startswith("BENCH ")]
+        if proc.returncode or not lines:
+            print(f"lần {i + 1}: process con lỗi (exit {proc.returncode})")
+            continue
+        rows.append(json.loads(lines[-1][6:]))
+
+    cols = ["python", "import", "ready"] + [name for name, _ in FIRST_UPDATES]
+    print(f"{'lần':<8}" + "".join(f"{c + ' ms':>12}" for c in cols))
+    for i, row in enumerate(rows):
+        label = "cold" if i == 0 or args.no_snapshots else "warm"
+        print(f"{f'{i + 1} {label}':<8}" + "".join(f"{row[c] * 1000:>12.0f}" for c in cols))
+    if len(rows) > 2:
+        print(f"{'median':<8}" + "".join(f"{statistics.median(r[c] for r in rows[1:]) * 1000:>12.0f}" for c in cols)
+              + "   (trừ lần đầu)")
+    print("\nupstream calls:", fakes.counts)
+
+    await runner.cleanup()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args():
+    from harness import add_upstream_args
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--restarts", type=int, default=4)
+    ap.add_argument("--settle", type=float, default=2.0, help="giây bot chạy tiếp sau phản hồi đầu trước khi dừng")
+    ap.add_argument("--no-snapshots", action="store_true", help="xóa snapshot trước mỗi lần (luôn cold start)")
+    ap.add_argument("--metrics-port", type=int, default=0, help="0 = tắt endpoint /metrics như harness")
+    add_upstream_args(ap)
+    return ap.parse_args()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--child"]:
+        asyncio.run(child())
+    else:
+        asyncio.run(run(parse_args()))
@@ -1,31 +1,87 @@
 # main.py
 import os
+import signal
 import json
+import re
 import asyncio
+import bisect
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
+import importlib.util
 import logging
+import mmap
+import operator
+import random
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import xml.etree.ElementTree as ET
+import zlib
+from array import array
+from collections import OrderedDict
 from datetime import datetime, time as dt_time, timedelta
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, AsyncIterator, Collection, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import aiohttp
-from bs4 import BeautifulSoup
 import html as pyhtml
 
-from telegram import Update, MessageEntity
+from telegram import (
+    InlineQueryResultArticle,
+    InlineQueryResultsButton,
+    InputTextMessageContent,
+    MessageEntity,
+    Update,
+)
 from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
 
+
+def lazy_import(name: str):
+    """Module chỉ thực sự được nạp ở lần truy cập thuộc tính đầu tiên"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+aiohttp = lazy_import("aiohttp")   # ~0.2s import, nạp trong post_init (xem STARTUP)
+
+
 # ===== CONFIG =====
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")        # keep as string for comparison
 GROUP_ID = os.getenv("GROUP_ID")        # optional
 CHATANYWHERE_API_KEY = os.getenv("CHATANYWHERE_API_KEY")
 CONFIG_FILE = "config.json"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))   # 0 = tắt endpoint /metrics
+USERS_DB = os.getenv("USERS_DB")        # optional: SQLite file for the user registry
+COORD_DB = os.getenv("COORD_DB")        # optional: SQLite file shared by replicas (leader lease, caches)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # set -> webhook mode (public https base URL)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+PORT = int(os.getenv("PORT", "8080"))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # optional, e.g. http://localhost:8081/bot
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN chưa được thiết lập!")
@@ -37,22 +93,591 @@ logging.basicConfig(
 )
 logger = logging.getLogger("girlhonghot")
 
-# ===== CONFIG HELPERS =====
-def load_config() -> Dict[str, Any]:
+# ===== COORDINATION =====
+# Nhiều replica dùng chung một file SQLite (WAL) qua COORD_DB. Lease "leader" quyết
+# định replica nào chạy broadcast và các tác vụ làm mới nền; leader ghi cache ấm
+# (coin list, tin, báo cáo) vào bảng kv, replica khác kéo về khi version đổi.
+# Trạng thái của leader (lịch báo cáo, checkpoint broadcast) nằm trong bảng state
+# để leader mới tiếp tục đúng chỗ leader cũ dừng. Config, user và alert cũng nằm
+# trong DB này để lệnh sửa chạy trên replica nào cũng không ghi đè lẫn nhau.
+# Không đặt COORD_DB: một instance, luôn là leader.
+REPLICA_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = 15.0               # giây; leader phải gia hạn trước khi hết
+LEASE_RENEW = 5.0              # giây giữa hai lần gia hạn
+SHARED_SYNC_INTERVAL = 2.0     # giây giữa hai lần follower kiểm tra cache chung
+_VERSION_BUMP = (
+    "INSERT INTO versions (name, version) VALUES (?, 1) "
+    "ON CONFLICT(name) DO UPDATE SET version = version + 1"
+)
+
+
+def open_shared_db(path: str) -> sqlite3.Connection:
+    """Kết nối SQLite dùng chung giữa các process (WAL, chờ lock tối đa 10s)"""
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+    return conn
+
+
+def table_version(conn: sqlite3.Connection, name: str) -> int:
+    row = conn.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+class Coordinator:
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.is_leader = False
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.jobs: List[Any] = []                      # coroutine function(app) chỉ chạy trên leader
+        self.tasks: List[asyncio.Task] = []
+        self.versions: Dict[str, int] = {}
+        self.on_lost: Optional[Any] = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.conn = open_shared_db(self.path)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "version INTEGER NOT NULL, updated REAL NOT NULL)"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.commit()
+        return self.conn
+
+    def try_lease(self) -> bool:
+        """Lấy / gia hạn lease nếu đang trống, hết hạn hoặc đã là của mình"""
+        now = time.time()
+        with self.lock:
+            conn = self._db()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT holder, expires FROM lease WHERE name = 'leader'").fetchone()
+                ok = row is None or row[0] == REPLICA_ID or row[1] < now
+                if ok:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO lease (name, holder, expires) VALUES ('leader', ?, ?)",
+                        (REPLICA_ID, now + LEASE_TTL),
+                    )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return ok
+
+    def release(self) -> None:
+        if self.path is None:
+            return
+        with self.lock:
+            conn = self._db()
+            with conn:
+                conn.execute("DELETE FROM lease WHERE name = 'leader' AND holder = ?", (REPLICA_ID,))
+
+    def _set_leader(self, app, leader: bool) -> None:
+        self.is_leader = leader
+        METRICS.set("bot_leader", (), 1 if leader else 0)
+        if leader:
+            logger.info("👑 %s là leader, chạy tác vụ nền.", REPLICA_ID)
+            self.tasks = [asyncio.create_task(job(app)) for job in self.jobs]
+            return
+        logger.warning("%s không còn là leader, dừng tác vụ nền.", REPLICA_ID)
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.on_lost is not None:
+            self.on_lost()
+
+    async def run(self, app) -> None:
+        if self.path is None:
+            self._set_leader(app, True)
+            return
+        renewed = 0.0
+        while True:
+            try:
+                leader = await asyncio.to_thread(self.try_lease)
+                if leader:
+                    renewed = time.monotonic()
+            except Exception as e:
+                logger.warning("Lỗi gia hạn lease: %s", e)
+                # chưa gia hạn được nhưng lease vẫn còn hạn thì giữ vai trò hiện tại
+                leader = self.is_leader and time.monotonic() - renewed < LEASE_TTL - LEASE_RENEW
+            if leader != self.is_leader:
+                self._set_leader(app, leader)
+            if not leader:
+                await self.pull()
+            await asyncio.sleep(LEASE_RENEW if leader else SHARED_SYNC_INTERVAL)
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.is_leader:
+            with contextlib.suppress(Exception):
+                await asyncio.to_thread(self.release)
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _publish(self, key: str, value: bytes) -> None:
+        with self.lock:
+            conn = self._db()
+            with conn:
+                conn.execute(
+                    "INSERT INTO kv (key, value, version, updated) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = excluded.value, version = version + 1, updated = excluded.updated",
+                    (key, value, time.time()),
+                )
+                row = conn.execute("SELECT version FROM kv WHERE key = ?", (key,)).fetchone()
+                self.versions[key] = row[0]
+
+    async def publish(self, key: str, value: bytes) -> None:
+        """Leader ghi cache ấm (đã mã hóa) cho các replica khác"""
+        if self.path is None or not self.is_leader:
+            return
+        try:
+            await asyncio.to_thread(self._publish, key, value)
+        except Exception as e:
+            logger.warning("Lỗi ghi cache chung %s: %s", key, e)
+
+    def _read_state(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self._db().execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write_state(self, key: str, value: Optional[str]) -> None:
+        with self.lock:
+            conn = self._db()
+            with conn:
+                if value is None:
+                    conn.execute("DELETE FROM state WHERE key = ?", (key,))
+                else:
+                    conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    async def load_state(self, key: str, path: str) -> Optional[Any]:
+        """Trạng thái JSON của leader: bảng state trong COORD_DB, một instance thì file `path`.
+
+        None nếu chưa có; dữ liệu hỏng / lỗi DB thì raise.
+        """
+        if self.path is not None:
+            raw = await asyncio.to_thread(self._read_state, key)
+            return None if raw is None else json.loads(raw)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    async def save_state(self, key: str, path: str, obj: Optional[Any]) -> None:
+        """Ghi trạng thái cho load_state(); obj None thì xóa"""
+        if self.path is not None:
+            await asyncio.to_thread(self._write_state, key, None if obj is None else json.dumps(obj))
+        elif obj is None:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        else:
+            await asyncio.to_thread(atomic_write_json, path, obj)
+
+    def _fetch_changed(self) -> Dict[str, Any]:
+        with self.lock:
+            conn = self._db()
+            changed = {}
+            for key, version in conn.execute("SELECT key, version FROM kv").fetchall():
+                if key in WARM_CACHES and self.versions.get(key) != version:
+                    row = conn.execute("SELECT value, version FROM kv WHERE key = ?", (key,)).fetchone()
+                    changed[key] = decode_cache(row[0])
+                    self.versions[key] = row[1]
+            return changed
+
+    async def pull(self) -> None:
+        """Follower: nạp các cache chung có version mới"""
+        if self.path is None:
+            return
+        try:
+            changed = await asyncio.to_thread(self._fetch_changed)
+        except Exception as e:
+            logger.warning("Lỗi đọc cache chung: %s", e)
+            return
+        await apply_warm_caches(changed, "cache chung")
+
+
+COORD = Coordinator(COORD_DB)
+
+
+# ===== WARM CACHES =====
+# Coin list, tin đã tải và báo cáo gần nhất được ghi (JSON gọn + zlib) vào
+# SNAPSHOT_DIR mỗi lần leader làm mới, và cũng là bản ghi trong bảng kv chung.
+# Lúc khởi động nạp lại snapshot để phục vụ ngay, dữ liệu mới tải nền sau.
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_LEVEL = 6             # mức nén zlib
+WARM_CACHES: Dict[str, Tuple[Any, Any]] = {}   # key -> (dump() -> obj | None, async load(obj))
+
+
+def warm_cache(key: str, dump, load) -> None:
+    WARM_CACHES[key] = (dump, load)
+
+
+def encode_cache(obj: Any) -> bytes:
+    return zlib.compress(json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), SNAPSHOT_LEVEL)
+
+
+def decode_cache(data: bytes) -> Any:
+    return json.loads(zlib.decompress(data))
+
+
+def _snapshot_path(key: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"{key}.json.z")
+
+
+def _write_snapshot(key: str, data: bytes) -> None:
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    atomic_write_bytes(_snapshot_path(key), data)
+
+
+def _read_snapshots() -> Dict[str, Any]:
+    out = {}
+    for key in WARM_CACHES:
+        try:
+            with open(_snapshot_path(key), "rb") as f:
+                out[key] = decode_cache(f.read())
+        except FileNotFoundError:
+            continue
+        except Exception as e:
+            logger.warning("Snapshot %s hỏng, bỏ qua: %s", key, e)
+    return out
+
+
+async def apply_warm_caches(objs: Dict[str, Any], origin: str) -> None:
+    for key, obj in objs.items():
+        try:
+            await WARM_CACHES[key][1](obj)
+        except Exception as e:
+            logger.warning("Lỗi nạp %s %s: %s", origin, key, e)
+
+
+async def load_snapshots() -> None:
+    """Nạp snapshot trên đĩa vào các cache (lúc khởi động)"""
+    objs = await asyncio.to_thread(_read_snapshots)
+    await apply_warm_caches(objs, "snapshot")
+    if objs:
+        logger.info("♻️ Đã nạp snapshot: %s", ", ".join(objs))
+
+
+async def share_cache(key: str) -> None:
+    """Leader: lưu cache `key` ra snapshot và bảng kv chung (nếu có)"""
+    if not COORD.is_leader:
+        return
+    obj = WARM_CACHES[key][0]()
+    if obj is None:
+        return
+    data = encode_cache(obj)
     try:
-        with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-            cfg = json.load(f)
-    except Exception:
-        cfg = {}
+        await asyncio.to_thread(_write_snapshot, key, data)
+    except OSError as e:
+        logger.warning("Lỗi ghi snapshot %s: %s", key, e)
+    await COORD.publish(key, data)
+
+
+# ===== CONFIG HELPERS =====
+CONFIG_SAVE_DELAY = 1.0        # giây, gộp các lần ghi liên tiếp thành một
+CONFIG_RECHECK = 1.0           # giây giữa hai lần stat() để phát hiện sửa tay
+
+
+def _config_defaults(cfg: Dict[str, Any]) -> Dict[str, Any]:
     cfg.setdefault("users", {})  # map id -> display name
     cfg.setdefault("news_sources", ["https://coin68.com/feed/"])
-    cfg.setdefault("report_time", "08:00")
+    cfg.setdefault("report_time", "08:00")  # "HH:MM" hoặc danh sách khung giờ
+    cfg.setdefault("timezone", "")          # vd "Asia/Ho_Chi_Minh"; rỗng = giờ máy chủ
+    cfg.setdefault("schedules", {})         # chat id -> {"times": [...], "tz": ...} riêng
+    cfg.setdefault("news_concurrency", 8)   # số feed tải song song tối đa
+    cfg.setdefault("news_deadline", 6)      # giây, hạn chót cho cả lượt tải RSS
+    cfg.setdefault("news_poll_interval", 300)  # giây, chu kỳ poll nền mỗi feed
+    cfg.setdefault("report_max_age", 300)   # giây, báo cáo cũ hơn thì dựng lại nền
+    cfg.setdefault("report_stale_max", 3600)  # giây, quá mức này /report phải chờ dựng mới
+    cfg.setdefault("report_prewarm", 5)     # phút, dựng sẵn báo cáo trước report_time
+    cfg.setdefault("news_digest", False)    # tóm tắt tiêu đề bằng AI trong báo cáo
+    cfg.setdefault("news_digest_tokens", 1500)  # ngân sách token mỗi báo cáo
+    cfg.setdefault("news_digest_deadline", 8)   # giây, quá thì dùng tiêu đề gốc
+    cfg.setdefault("history_coins", ["bitcoin", "ethereum", "binancecoin", "solana", "ripple"])  # lưu lịch sử giá cho /chart
     return cfg
 
 
-def save_config(cfg: Dict[str, Any]) -> None:
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(cfg, f, indent=2, ensure_ascii=False)
+def atomic_write_bytes(path: str, data: bytes) -> None:
+    """Ghi ra file tạm, fsync rồi rename — không bao giờ để lại file dở dang"""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def atomic_write_json(path: str, obj: Any, indent: Optional[int] = 2) -> None:
+    atomic_write_bytes(path, json.dumps(obj, indent=indent, ensure_ascii=False).encode("utf-8"))
+
+
+class ConfigStore:
+    """Config giữ trong RAM; ghi đĩa atomic (file tạm + rename), có debounce.
+
+    File bị sửa ngoài bot được nạp lại khi mtime thay đổi.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = asyncio.Lock()
+        self._cfg: Optional[Dict[str, Any]] = None
+        self._mtime: Optional[int] = None
+        self._checked = 0.0
+        self._save_task: Optional[asyncio.Task] = None
+
+    def _stat_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cfg = json.load(f)
+        except Exception:
+            cfg = {}
+        self._cfg = _config_defaults(cfg if isinstance(cfg, dict) else {})
+        self._mtime = self._stat_mtime()
+
+    def get(self) -> Dict[str, Any]:
+        if self._cfg is None:
+            self._read()
+        elif self._save_task is None:
+            now = time.monotonic()
+            if now - self._checked >= CONFIG_RECHECK:
+                self._checked = now
+                if self._stat_mtime() != self._mtime:
+                    logger.info("%s thay đổi ngoài bot, nạp lại.", self.path)
+                    self._read()
+        return self._cfg
+
+    def _write(self) -> None:
+        atomic_write_json(self.path, self._cfg)
+        self._mtime = self._stat_mtime()
+
+    async def _save_later(self) -> None:
+        await asyncio.sleep(CONFIG_SAVE_DELAY)
+        async with self.lock:
+            self._save_task = None
+            self._write()
+
+    def save(self) -> None:
+        """Lên lịch ghi (debounce); ghi ngay nếu không có event loop"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write()
+            return
+        if self._save_task is None or self._save_task.done():
+            self._save_task = loop.create_task(self._save_later())
+
+    async def flush(self) -> None:
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+            self._save_task = None
+            async with self.lock:
+                self._write()
+
+    @contextlib.asynccontextmanager
+    async def edit(self):
+        """Sửa config dưới lock; chỉ lưu nếu khối lệnh không lỗi và config thực sự đổi"""
+        async with self.lock:
+            cfg = self.get()
+            before = json.dumps(cfg, sort_keys=True)
+            yield cfg
+            if json.dumps(cfg, sort_keys=True) != before:
+                self.save()
+
+
+class SharedConfigStore(ConfigStore):
+    """Config trong bảng SQLite dùng chung (COORD_DB) cho nhiều replica.
+
+    edit() đọc bản mới nhất và ghi lại trong cùng một transaction (BEGIN IMMEDIATE)
+    nên hai replica sửa cùng lúc không ghi đè lên nhau. Lần đầu chuyển nội dung
+    config.json vào DB; sau đó sửa config qua lệnh bot, file không còn được đọc.
+    """
+
+    def __init__(self, db_path: str, path: str):
+        super().__init__(path)
+        self.conn = open_shared_db(db_path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS config (id INTEGER PRIMARY KEY CHECK (id = 1), value TEXT NOT NULL)")
+        self.conn.commit()
+        self.version = 0
+        if self.conn.execute("SELECT 1 FROM config").fetchone() is None:
+            super()._read()
+            self._store()
+            logger.info("Đã chuyển %s sang %s", path, db_path)
+        self._read()
+
+    def _read(self) -> None:
+        self.version = table_version(self.conn, "config")
+        (value,) = self.conn.execute("SELECT value FROM config WHERE id = 1").fetchone()
+        self._cfg = _config_defaults(json.loads(value))
+
+    def _store(self) -> None:
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO config (id, value) VALUES (1, ?)", (json.dumps(self._cfg, ensure_ascii=False),))
+            self.conn.execute(_VERSION_BUMP, ("config",))
+            self.version = table_version(self.conn, "config")
+
+    def _begin(self) -> None:
+        self.conn.execute("BEGIN IMMEDIATE")
+        self._read()
+
+    def get(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        if now - self._checked >= CONFIG_RECHECK:
+            self._checked = now
+            try:
+                if table_version(self.conn, "config") != self.version:
+                    self._read()
+            except sqlite3.Error as e:
+                logger.warning("Lỗi đọc lại bảng config: %s", e)
+        return self._cfg
+
+    def save(self) -> None:
+        """Ghi ngay toàn bộ config — chỉ dùng lúc khởi động, sau đó sửa qua edit()"""
+        self._store()
+
+    @contextlib.asynccontextmanager
+    async def edit(self):
+        async with self.lock:
+            await asyncio.to_thread(self._begin)
+            before = json.dumps(self._cfg, sort_keys=True)
+            try:
+                yield self._cfg
+            except BaseException:
+                await asyncio.to_thread(self.conn.rollback)
+                self._read()   # bỏ thay đổi dở dang trong RAM
+                raise
+            if json.dumps(self._cfg, sort_keys=True) != before:
+                await asyncio.to_thread(self._store)
+            else:
+                await asyncio.to_thread(self.conn.rollback)
+
+
+class UserStore:
+    """Registry người dùng: dict id -> tên trong RAM, tra cứu O(1)"""
+
+    def __init__(self, config: ConfigStore):
+        self.config = config
+
+    def _users(self) -> Dict[str, str]:
+        return self.config.get()["users"]
+
+    def __contains__(self, uid: Any) -> bool:
+        return str(uid) in self._users()
+
+    def __len__(self) -> int:
+        return len(self._users())
+
+    def get(self, uid: Any) -> Optional[str]:
+        return self._users().get(str(uid))
+
+    def items(self) -> List[Tuple[str, str]]:
+        return list(self._users().items())
+
+    def ids(self) -> List[str]:
+        return list(self._users())
+
+    async def add(self, uid: Any, name: str) -> None:
+        async with self.config.edit() as cfg:
+            cfg["users"][str(uid)] = name
+
+    async def remove(self, uid: Any) -> bool:
+        async with self.config.edit() as cfg:
+            return cfg["users"].pop(str(uid), None) is not None
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteUserStore(UserStore):
+    """Registry trong SQLite (WAL) cho danh sách lớn; vẫn đọc từ cache RAM.
+
+    Lần đầu mở sẽ chuyển user từ config.json sang DB. Khi nhiều replica dùng
+    chung file, cache được nạp lại nếu version bảng users đổi.
+    """
+
+    def __init__(self, config: ConfigStore, path: str):
+        super().__init__(config)
+        self.lock = asyncio.Lock()
+        self.conn = open_shared_db(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, name TEXT NOT NULL)")
+        self.conn.commit()
+        self.version = table_version(self.conn, "users")
+        self.checked = time.monotonic()
+        self.cache: Dict[str, str] = dict(self.conn.execute("SELECT id, name FROM users"))
+        legacy = config.get().get("users") or {}
+        if legacy:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO users (id, name) VALUES (?, ?)", list(legacy.items())
+                )
+                self.conn.execute(_VERSION_BUMP, ("users",))
+            for uid, name in legacy.items():
+                self.cache.setdefault(uid, name)
+            config.get()["users"] = {}
+            config.save()
+            logger.info("Đã chuyển %d user từ %s sang %s", len(legacy), config.path, path)
+
+    def _users(self) -> Dict[str, str]:
+        now = time.monotonic()
+        if now - self.checked >= CONFIG_RECHECK:
+            self.checked = now
+            try:
+                version = table_version(self.conn, "users")
+                if version != self.version:
+                    self.cache = dict(self.conn.execute("SELECT id, name FROM users"))
+                    self.version = version
+            except sqlite3.Error as e:
+                logger.warning("Lỗi đọc lại bảng users: %s", e)
+        return self.cache
+
+    def _execute(self, sql: str, params: Tuple[Any, ...]) -> None:
+        with self.conn:
+            self.conn.execute(sql, params)
+            self.conn.execute(_VERSION_BUMP, ("users",))
+            version = table_version(self.conn, "users")
+        # chỉ có ghi của mình xen vào -> cache vẫn khớp, không cần nạp lại
+        if version == self.version + 1:
+            self.version = version
+
+    async def add(self, uid: Any, name: str) -> None:
+        async with self.lock:
+            await asyncio.to_thread(
+                self._execute, "INSERT OR REPLACE INTO users (id, name) VALUES (?, ?)", (str(uid), name)
+            )
+            self.cache[str(uid)] = name
+
+    async def remove(self, uid: Any) -> bool:
+        async with self.lock:
+            if str(uid) not in self._users():
+                return False
+            await asyncio.to_thread(self._execute, "DELETE FROM users WHERE id = ?", (str(uid),))
+            self.cache.pop(str(uid), None)
+            return True
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+CONFIG: ConfigStore = SharedConfigStore(COORD_DB, CONFIG_FILE) if COORD_DB else ConfigStore(CONFIG_FILE)
+_users_db = USERS_DB or COORD_DB
+USERS: UserStore = SqliteUserStore(CONFIG, _users_db) if _users_db else UserStore(CONFIG)
+
+
+def load_config() -> Dict[str, Any]:
+    """Config hiện tại (bản trong RAM, không đọc lại đĩa) — chỉ đọc, sửa qua CONFIG.edit()"""
+    return CONFIG.get()
 
 
 def is_admin(uid: int) -> bool:
@@ -60,436 +685,3088 @@ def is_admin(uid: int) -> bool:
 
 
 def is_registered(uid: int) -> bool:
-    return str(uid) in load_config().get("users", {})
+    return uid in USERS
 
 
 # ===== TELEGRAM APP =====
-application = ApplicationBuilder().token(BOT_TOKEN).build()
+_builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(UPDATE_CONCURRENCY)
+if TELEGRAM_API_URL:  # vd. Bot API server tự host
+    _builder = _builder.base_url(TELEGRAM_API_URL)
+application = _builder.build()
 
 # ===== UTILS & CACHES =====
-COIN_CACHE: Dict[str, Any] = {"last_update": 0, "data": []}
+COIN_CACHE: Dict[str, Any] = {"last_update": 0, "index": None, "refresh": None, "partial": False}
 
 
-async def fetch_json(url: str, timeout: int = 10) -> Any:
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=timeout) as resp:
-                resp.raise_for_status()
-                return await resp.json()
-    except Exception as e:
-        logger.warning("fetch_json lỗi %s: %s", url, e)
-        return {}
-
+# ===== METRICS =====
+# Registry tối giản kiểu Prometheus (counter / gauge / histogram) không cần thư viện
+# ngoài; xuất ra text format qua metrics_server và tóm tắt bằng /stats.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+Labels = Tuple[Tuple[str, str], ...]
 
-async def fetch_text(url: str, timeout: int = 10) -> Optional[bytes]:
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=timeout) as resp:
-                resp.raise_for_status()
-                return await resp.read()
-    except Exception as e:
-        logger.warning("fetch_text lỗi %s: %s", url, e)
-        return None
 
+class Metrics:
+    def __init__(self):
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, List[float]]] = {}   # [bucket..., +Inf, sum]
+        self.help: Dict[str, str] = {}
+        self.collectors: List[Any] = []
+        self.started = time.time()
 
-async def fetch_items_from_feed(src: str) -> List[Any]:
-    try:
-        headers = {"User-Agent": "Mozilla/5.0 (compatible; girlhonghotBot/1.0)"}
-        async with aiohttp.ClientSession() as session:
-            async with session.get(src, headers=headers, timeout=8) as r:
-                content = await r.read()
-        soup = BeautifulSoup(content, "xml")
-        items = soup.find_all("item")
-        if not items:
-            soup = BeautifulSoup(content, "html.parser")
-            items = soup.find_all("item")
-        return items
-    except Exception as e:
-        logger.warning("Lỗi RSS %s: %s", src, e)
-        return []
+    def inc(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
 
+    def set(self, name: str, labels: Labels = (), value: float = 0) -> None:
+        self.gauges.setdefault(name, {})[labels] = value
 
-# ===== COMMAND HANDLERS =====
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    if not (is_registered(user.id) or is_admin(user.id)):
-        await update.message.reply_text("🔒 Bạn chưa được kích hoạt. Dùng /dangky để gửi yêu cầu.")
-        return
-    await update.message.reply_text(
-        f"👋 Chào {user.first_name}! Tôi là @girlhonghot – trợ lý crypto của bạn 💖"
-    )
+    def add(self, name: str, labels: Labels = (), value: float = 1) -> None:
+        series = self.gauges.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
 
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        series = self.histograms.setdefault(name, {})
+        h = series.get(labels)
+        if h is None:
+            h = series[labels] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+        h[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        h[-1] += value
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = (
-        "💡 *Hướng dẫn sử dụng:*\n"
-        "• /start – Bắt đầu trò chuyện\n"
-        "• /dangky – Gửi yêu cầu đăng ký\n"
-        "• /price <coin> – Xem giá coin\n"
-        "• /top – Top 10 coin theo vốn hóa\n"
-        "• /news – Tin tức RSS\n"
-        "• /report – Báo cáo thủ công\n"
-        "• /help – Hướng dẫn\n"
-        "👑 *Admin:* /them, /xoa, /listuser, /addnews, /delnews, /settime"
-    )
-    await update.message.reply_text(text, parse_mode="Markdown")
+    @staticmethod
+    def count(h: List[float]) -> float:
+        return sum(h[:-1])
 
+    @staticmethod
+    def quantile(h: List[float], q: float) -> float:
+        """Ước lượng quantile bằng cận trên của bucket"""
+        target, acc = q * Metrics.count(h), 0.0
+        for i, n in enumerate(h[:-1]):
+            acc += n
+            if acc >= target and n:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
 
-# ===== USER MANAGEMENT =====
-async def dangky(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    cfg = load_config()
-    if str(user.id) in cfg["users"]:
-        await update.message.reply_text("✅ Bạn đã được kích hoạt!")
-        return
-    msg = f"📩 *YÊU CẦU ĐĂNG KÝ*\n👤 @{user.username or 'Không có'}\n🆔 `{user.id}`"
-    if ADMIN_ID:
+    @contextlib.contextmanager
+    def timer(self, prefix: str, labels: Labels):
+        """Đo latency + in-flight + lỗi cho một khối lệnh"""
+        self.add(f"{prefix}_in_flight", labels, 1)
+        start = time.perf_counter()
         try:
-            await context.bot.send_message(int(ADMIN_ID), msg, parse_mode="Markdown")
-        except Exception as e:
-            logger.warning("Lỗi gửi tin admin: %s", e)
-    await update.message.reply_text("🕐 Đã gửi yêu cầu đến admin, vui lòng chờ duyệt 💬")
+            yield
+        except Exception:
+            self.inc(f"{prefix}_errors_total", labels)
+            raise
+        finally:
+            self.observe(f"{prefix}_latency_seconds", labels, time.perf_counter() - start)
+            self.add(f"{prefix}_in_flight", labels, -1)
 
+    def render(self) -> str:
+        for collect in self.collectors:
+            try:
+                collect(self)
+            except Exception as e:
+                logger.warning("Lỗi collector metrics: %s", e)
 
-async def them(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Không có quyền.")
-        return
-    if not context.args:
-        await update.message.reply_text("❌ Sai cú pháp: /them <id>")
-        return
-    uid = context.args[0]
-    cfg = load_config()
-    try:
-        user_info = await context.bot.get_chat(uid)
-        cfg["users"][uid] = user_info.username or user_info.first_name or "User"
-        save_config(cfg)
-        await update.message.reply_text(f"✅ Đã kích hoạt {cfg['users'][uid]} ({uid})")
-        try:
-            await context.bot.send_message(int(uid), "🎉 Bạn đã được kích hoạt! 💖")
-        except Exception:
-            pass
-    except Exception as e:
-        await update.message.reply_text(f"❌ Lỗi: {e}")
+        def fmt(labels: Labels, extra: str = "") -> str:
+            parts = [f'{k}="{v}"' for k, v in labels] + ([extra] if extra else [])
+            return "{" + ",".join(parts) + "}" if parts else ""
 
+        out = []
+        for kind, family in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted(family):
+                out.append(f"# TYPE {name} {kind}")
+                out.extend(f"{name}{fmt(lb)} {v:g}" for lb, v in family[name].items())
+        for name in sorted(self.histograms):
+            out.append(f"# TYPE {name} histogram")
+            for lb, h in self.histograms[name].items():
+                acc = 0.0
+                for i, n in enumerate(h[:-1]):
+                    acc += n
+                    le = f"{LATENCY_BUCKETS[i]:g}" if i < len(LATENCY_BUCKETS) else "+Inf"
+                    le_label = 'le="%s"' % le
+                    out.append(f"{name}_bucket{fmt(lb, le_label)} {acc:g}")
+                out.append(f"{name}_sum{fmt(lb)} {h[-1]:g}")
+                out.append(f"{name}_count{fmt(lb)} {acc:g}")
+        return "\n".join(out) + "\n"
 
-async def xoa(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Không có quyền.")
-        return
-    if not context.args:
-        await update.message.reply_text("❌ Sai cú pháp: /xoa <id>")
-        return
-    uid = context.args[0]
-    cfg = load_config()
-    if uid not in cfg["users"]:
-        await update.message.reply_text("❌ Không tìm thấy user này.")
-        return
-    del cfg["users"][uid]
-    save_config(cfg)
-    await update.message.reply_text(f"🗑️ Đã xóa {uid}")
 
+METRICS = Metrics()
 
-async def listuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Không có quyền.")
-        return
-    cfg = load_config()
-    if not cfg["users"]:
-        await update.message.reply_text("📭 Chưa có người dùng nào.")
-        return
-    msg = "👥 *Danh sách người dùng:*\n\n"
-    for k, v in cfg["users"].items():
-        msg += f"• {v} – `{k}`\n"
-    await update.message.reply_text(msg, parse_mode="Markdown")
 
+def cache_hit(cache: str, result: str) -> None:
+    METRICS.inc("bot_cache_requests_total", (("cache", cache), ("result", result)))
 
-# ===== NEWS HANDLERS =====
-async def news(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cfg = load_config()
-    msg = "📰 <b>TIN TỨC CRYPTO MỚI NHẤT</b>\n\n"
-    for src in cfg.get("news_sources", []):
-        items = await fetch_items_from_feed(src)
-        if not items:
-            msg += f"⚠️ Không tìm thấy tin nào từ {src}\n\n"
-            continue
-        for i in items[:5]:
-            title = pyhtml.escape(
-                getattr(i, "title", "").text.strip() if getattr(i, "title", None) else "Không có tiêu đề"
-            )
-            link = None
-            if i.find("link") and getattr(i.find("link"), "text", "").strip().startswith("http"):
-                link = i.find("link").text.strip()
-            elif i.find("guid") and "http" in getattr(i.find("guid"), "text", ""):
-                link = i.find("guid").text.strip()
-            else:
-                link = src
-            msg += f"• <a href=\"{link}\">{title}</a>\n"
-        msg += "\n"
-    await update.message.reply_text(msg, parse_mode="HTML", disable_web_page_preview=False)
 
+async def _trace_start(session, ctx, params) -> None:
+    ctx.labels = (("host", params.url.host or ""),)
+    ctx.start = time.perf_counter()
+    METRICS.add("bot_upstream_in_flight", ctx.labels, 1)
+
+
+async def _trace_end(session, ctx, params) -> None:
+    METRICS.add("bot_upstream_in_flight", ctx.labels, -1)
+    METRICS.observe("bot_upstream_latency_seconds", ctx.labels, time.perf_counter() - ctx.start)
+    METRICS.inc("bot_upstream_responses_total", ctx.labels + (("code", f"{params.response.status // 100}xx"),))
+
+
+async def _trace_error(session, ctx, params) -> None:
+    METRICS.add("bot_upstream_in_flight", ctx.labels, -1)
+    METRICS.observe("bot_upstream_latency_seconds", ctx.labels, time.perf_counter() - ctx.start)
+    METRICS.inc("bot_upstream_errors_total", ctx.labels)
+
+
+def upstream_trace_config() -> "aiohttp.TraceConfig":
+    tc = aiohttp.TraceConfig()
+    tc.on_request_start.append(_trace_start)
+    tc.on_request_end.append(_trace_end)
+    tc.on_request_exception.append(_trace_error)
+    return tc
+
+
+# ===== HTTP CLIENT =====
+# One pooled session for the whole app: keep-alive + DNS cache instead of a new
+# TCP/TLS handshake per request. Created on first use, closed in post_shutdown.
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; girlhonghotBot/1.0)",
+    "Accept-Encoding": "gzip, deflate",
+}
+HTTP_TIMEOUTS = {             # tham số aiohttp.ClientTimeout theo loại upstream
+    "coingecko": {"total": 10, "sock_connect": 5},
+    "rss": {"total": 8, "sock_connect": 4},
+    "ai": {"total": 30, "sock_connect": 5},
+    "ai_stream": {"total": 120, "sock_connect": 5, "sock_read": 30},
+}
+HTTP_SESSION: Optional["aiohttp.ClientSession"] = None
+
+
+@functools.lru_cache(maxsize=None)
+def http_timeout(kind: str) -> "aiohttp.ClientTimeout":
+    return aiohttp.ClientTimeout(**HTTP_TIMEOUTS[kind])
+
+
+def get_session() -> "aiohttp.ClientSession":
+    """Trả về session dùng chung (tạo ở lần gọi đầu tiên)"""
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=10,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        HTTP_SESSION = aiohttp.ClientSession(
+            connector=connector,
+            headers=HTTP_HEADERS,
+            timeout=http_timeout("coingecko"),
+            trace_configs=[upstream_trace_config()],
+        )
+    return HTTP_SESSION
+
+
+async def close_session() -> None:
+    global HTTP_SESSION
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+    HTTP_SESSION = None
+
+
+# ===== NEWS STORE / POLLER =====
+# Bài viết đã parse được giữ trong RAM theo nguồn; /news và /report đọc từ đây,
+# feed_poller_task làm mới nền bằng conditional GET (ETag / Last-Modified).
+FEED_MAX_ITEMS = 30            # số bài tối đa giữ lại cho mỗi nguồn
+FEED_POLL_TICK = 5             # giây giữa các lần kiểm tra lịch poll
+FEED_MAX_BACKOFF = 3600        # giây, trần backoff khi nguồn lỗi liên tục
+FEED_STORE: Dict[str, Dict[str, Any]] = {}
+
+
+def _feed_state(src: str) -> Dict[str, Any]:
+    return FEED_STORE.setdefault(src, {
+        "items": None,
+        "etag": None,
+        "last_modified": None,
+        "failures": 0,
+        "next_poll": 0.0,
+        "updated": 0.0,
+    })
+
+
+class Article(NamedTuple):
+    title: str
+    link: str
+    published: str
+    source: str
+
+
+FEED_PARSE_CHUNK = 64 * 1024   # bytes đưa vào pull parser mỗi lần
+_FEED_ITEM_TAGS = ("item", "entry")                  # RSS 0.9x/1.0/2.0, Atom
+_FEED_DATE_TAGS = ("pubDate", "published", "updated", "date")
+
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _article_from_elem(elem: ET.Element, src: str) -> Article:
+    title = link = guid = published = ""
+    alternate = False
+    for child in elem:
+        name = _local_name(child.tag)
+        if name == "title":
+            title = "".join(child.itertext()).strip()
+        elif name == "link":
+            href = child.get("href")
+            if href:  # Atom: ưu tiên rel="alternate"
+                rel = child.get("rel", "alternate")
+                if rel == "alternate" and not alternate:
+                    link, alternate = href.strip(), True
+                elif not link:
+                    link = href.strip()
+            elif child.text and child.text.strip().startswith("http"):
+                link = child.text.strip()
+        elif name in ("guid", "id"):
+            guid = (child.text or "").strip()
+        elif name in _FEED_DATE_TAGS and not published:
+            published = (child.text or "").strip()
+    if not link:
+        link = guid if "http" in guid else src
+    return Article(title or "Không có tiêu đề", link, published, src)
+
+
+def _parse_feed_html(content: bytes, src: str, limit: int) -> List[Article]:
+    """Fallback cho trang không phải XML hợp lệ (vd. HTML có thẻ <item>)"""
+    from bs4 import BeautifulSoup   # nặng, chỉ cần khi feed hỏng
+
+    soup = BeautifulSoup(content, "html.parser")
+    articles = []
+    for i in soup.find_all("item", limit=limit):
+        title = i.title.text.strip() if i.title else "Không có tiêu đề"
+        link_tag, guid_tag = i.find("link"), i.find("guid")
+        if link_tag and link_tag.text.strip().startswith("http"):
+            link = link_tag.text.strip()
+        elif guid_tag and "http" in guid_tag.text:
+            link = guid_tag.text.strip()
+        else:
+            link = src
+        articles.append(Article(title, link, "", src))
+    return articles
+
+
+def parse_feed(content: bytes, src: str, limit: int = FEED_MAX_ITEMS) -> List[Article]:
+    """Parse RSS/Atom kiểu streaming, dừng ngay khi đủ `limit` bài."""
+    parser = ET.XMLPullParser(events=("end",))
+    articles: List[Article] = []
+    try:
+        for pos in range(0, len(content), FEED_PARSE_CHUNK):
+            parser.feed(content[pos:pos + FEED_PARSE_CHUNK])
+            for _, elem in parser.read_events():
+                if _local_name(elem.tag) in _FEED_ITEM_TAGS:
+                    articles.append(_article_from_elem(elem, src))
+                    elem.clear()
+                    if len(articles) >= limit:
+                        return articles
+        parser.close()
+    except ET.ParseError:
+        if not articles:
+            return _parse_feed_html(content, src, limit)
+    return articles
+
+
+async def fetch_items_from_feed(src: str) -> List[Article]:
+    """Tải một feed (conditional GET) và cập nhật FEED_STORE.
+
+    Khi lỗi trả về bản đã lưu gần nhất (có thể rỗng).
+    """
+    st = _feed_state(src)
+    headers = {}
+    if st["items"] is not None:
+        if st["etag"]:
+            headers["If-None-Match"] = st["etag"]
+        if st["last_modified"]:
+            headers["If-Modified-Since"] = st["last_modified"]
+    try:
+        async with get_session().get(src, headers=headers, timeout=http_timeout("rss")) as r:
+            if r.status == 304:
+                content = None
+            else:
+                r.raise_for_status()
+                content = await r.read()
+                etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        if content is not None:
+            st["items"] = parse_feed(content, src)
+            st["etag"], st["last_modified"] = etag, last_modified
+        METRICS.inc("bot_feed_fetch_total", (("result", "not_modified" if content is None else "ok"),))
+        st["failures"] = 0
+        st["updated"] = time.time()
+    except Exception as e:
+        logger.warning("Lỗi RSS %s: %s", src, e)
+        METRICS.inc("bot_feed_fetch_total", (("result", "error"),))
+        st["failures"] += 1
+    except asyncio.CancelledError:  # quá hạn chót news_deadline: cũng tính là lỗi để poller backoff
+        METRICS.inc("bot_feed_fetch_total", (("result", "deadline"),))
+        st["failures"] += 1
+        raise
+    return st["items"] or []
+
+
+async def fetch_all_feeds(
+    cfg: Dict[str, Any], sources: Optional[List[str]] = None, background: bool = False
+) -> Dict[str, Optional[List[Article]]]:
+    """Tải các nguồn tin song song trong một hạn chót chung `news_deadline`.
+
+    Trả về dict src -> items; src quá hạn có giá trị None. `background`: không
+    áp hạn chót, mỗi request chỉ bị giới hạn bởi timeout RSS.
+    """
+    if sources is None:
+        sources = list(cfg.get("news_sources", []))
+    sem = asyncio.Semaphore(max(1, int(cfg.get("news_concurrency", 8))))
+
+    async def _one(src: str) -> List[Article]:
+        async with sem:
+            return await fetch_items_from_feed(src)
+
+    tasks = {src: asyncio.create_task(_one(src)) for src in sources}
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=None if background else float(cfg.get("news_deadline", 6)))
+    results: Dict[str, Optional[List[Article]]] = {}
+    late = []
+    for src, task in tasks.items():
+        if task.done():
+            results[src] = task.result()
+        else:
+            task.cancel()
+            late.append(task)
+            results[src] = None
+    # chờ các task bị hủy ghi nhận lỗi vào FEED_STORE trước khi trả về
+    await asyncio.gather(*late, return_exceptions=True)
+    return results
+
+
+async def get_news(cfg: Dict[str, Any]) -> Dict[str, Optional[List[Article]]]:
+    """Đọc tin từ FEED_STORE; chỉ tải trực tiếp các nguồn chưa từng được thử.
+
+    Nguồn đã lỗi để feed_poller_task thử lại theo backoff, không tải lại mỗi lần /news.
+    Nguồn chưa tải thành công lần nào (đang chờ, quá hạn, lỗi) có giá trị None.
+    """
+    sources = list(cfg.get("news_sources", []))
+    missing = [s for s in sources if s not in FEED_STORE]
+    if missing:
+        await fetch_all_feeds(cfg, missing)
+    return {s: FEED_STORE.get(s, {}).get("items") for s in sources}
+
+
+def render_feed_items(items: List[Article], limit: int, summaries: Optional[Dict[int, str]] = None) -> str:
+    """Danh sách link HTML; có `summaries` (url key -> tóm tắt) thì thay tiêu đề bằng tóm tắt"""
+    out = ""
+    for a in items[:limit]:
+        text = summaries.get(url_key(a.link), a.title) if summaries else a.title
+        out += f"• <a href=\"{pyhtml.escape(a.link)}\">{pyhtml.escape(text)}</a>\n"
+    return out
+
+
+def _next_poll_delay(cfg: Dict[str, Any], src: str, failures: int) -> float:
+    interval = float(cfg.get("news_poll_intervals", {}).get(src, cfg.get("news_poll_interval", 300)))
+    if failures:
+        interval = min(interval * 2 ** min(failures, 10), FEED_MAX_BACKOFF)
+    return interval
+
+
+async def feed_poller_task(app):
+    """Tác vụ nền: làm mới từng nguồn tin theo chu kỳ riêng, backoff khi lỗi"""
+    logger.info("Feed poller started.")
+    while True:
+        try:
+            cfg = load_config()
+            sources = list(cfg.get("news_sources", []))
+            for src in list(FEED_STORE):
+                if src not in sources:
+                    del FEED_STORE[src]
+            now = time.monotonic()
+            due = [s for s in sources if _feed_state(s)["next_poll"] <= now]
+            if due:
+                before = {src: FEED_STORE[src]["items"] for src in due}
+                await fetch_all_feeds(cfg, due, background=True)
+                now = time.monotonic()
+                for src in due:
+                    st = _feed_state(src)
+                    st["next_poll"] = now + _next_poll_delay(cfg, src, st["failures"])
+                if any(FEED_STORE[src]["items"] is not before[src] for src in due):
+                    await share_cache("feeds")
+        except Exception as e:
+            logger.warning("Lỗi feed poller: %s", e)
+        await asyncio.sleep(FEED_POLL_TICK)
+
+
+def _dump_feeds() -> Dict[str, Any]:
+    return {
+        src: {"items": [list(a) for a in st["items"]], "etag": st["etag"], "last_modified": st["last_modified"]}
+        for src, st in FEED_STORE.items() if st["items"] is not None
+    }
+
+
+async def _load_feeds(obj: Dict[str, Any]) -> None:
+    """Bài từ snapshot / leader; poller vẫn làm mới (conditional GET) khi tới lượt"""
+    for src, saved in obj.items():
+        st = _feed_state(src)
+        st["items"] = [Article(*a) for a in saved["items"]]
+        st["etag"], st["last_modified"] = saved["etag"], saved["last_modified"]
+        st["updated"] = time.time()
+
+
+warm_cache("feeds", _dump_feeds, _load_feeds)
+
+
+# ===== NEWS DEDUP =====
+# Nhiều nguồn đăng lại cùng một tin: so khớp URL đã chuẩn hóa và MinHash của tập
+# từ trong tiêu đề (ước lượng Jaccard). Ứng viên gần trùng tìm qua LSH: chữ ký
+# 32 giá trị chia 16 band x 2, chỉ so với các bài trùng ít nhất một band.
+NEWS_SEEN_FILE = os.getenv("NEWS_SEEN_FILE", "news_seen.bin")
+NEWS_SEEN_MAX = 5000           # số bài đã gửi được nhớ cho mỗi khung giờ (trần bộ nhớ cố định)
+MINHASH_PERMS = 32             # blake2b-512 của mỗi từ = 32 hash 16-bit
+MINHASH_ROWS = 2               # giá trị mỗi band LSH
+NEWS_SIMILARITY = 0.6          # Jaccard ước lượng tối thiểu để coi là cùng tin
+NEWS_MIN_TOKENS = 3            # tiêu đề quá ngắn thì chỉ so URL
+NEWS_FINGERPRINT_CACHE = 4096  # bài trong FEED_STORE không đổi giữa các lần đọc
+_TRACKING_PARAMS = re.compile(r"^(utm_\w+|fbclid|gclid|mc_cid|mc_eid|ref|ref_src|source|outputType)$", re.I)
+_TITLE_TOKEN_RE = re.compile(r"\w+")
+_NO_SIG = bytes(MINHASH_PERMS * 2)
+
+
+def normalize_url(url: str) -> str:
+    """Bỏ scheme/www/fragment/tham số tracking và '/' cuối, sắp xếp query"""
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+    host = parts.netloc.lower().removeprefix("www.").removeprefix("m.")
+    path = re.sub(r"/(amp/?)?$", "", parts.path) or "/"
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not _TRACKING_PARAMS.match(k))
+    return f"{host}{path}" + (f"?{urlencode(query)}" if query else "")
+
+
+def url_key(url: str) -> int:
+    digest = hashlib.blake2b(normalize_url(url).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def minhash(title: str) -> Optional[bytes]:
+    """Chữ ký MinHash (MINHASH_PERMS x uint16) của tập từ đã bỏ dấu; None nếu quá ngắn"""
+    tokens = set(_TITLE_TOKEN_RE.findall(strip_diacritics(title).casefold()))
+    if len(tokens) < NEWS_MIN_TOKENS:
+        return None
+    columns = [array("H", hashlib.blake2b(t.encode()).digest()) for t in tokens]
+    return array("H", map(min, *columns)).tobytes()
+
+
+def _similarity(a: bytes, b: bytes) -> float:
+    return sum(map(operator.eq, array("H", a), array("H", b))) / MINHASH_PERMS
+
+
+def _bands(sig: bytes) -> List[bytes]:
+    width = MINHASH_ROWS * 2
+    return [bytes((i,)) + sig[i:i + width] for i in range(0, len(sig), width)]
+
+
+class DedupIndex:
+    """Tập (URL key, chữ ký) có giới hạn (FIFO): trùng URL O(1), gần trùng qua band LSH"""
+
+    RECORD = struct.Struct(f"<Q{MINHASH_PERMS * 2}s")
+
+    def __init__(self, max_items: int = 0):
+        self.max_items = max_items
+        self.entries: "OrderedDict[int, Optional[bytes]]" = OrderedDict()   # url key -> chữ ký
+        self.buckets: Dict[bytes, set] = {}                                # band -> url keys
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def contains(self, key: int, sig: Optional[bytes]) -> bool:
+        if key in self.entries:
+            return True
+        if sig is None:
+            return False
+        checked = set()
+        for band in _bands(sig):
+            for other in self.buckets.get(band, ()):
+                if other not in checked:
+                    checked.add(other)
+                    if _similarity(sig, self.entries[other]) >= NEWS_SIMILARITY:
+                        return True
+        return False
+
+    def add(self, key: int, sig: Optional[bytes]) -> None:
+        if key in self.entries:
+            return
+        self.entries[key] = sig
+        if sig is not None:
+            for band in _bands(sig):
+                self.buckets.setdefault(band, set()).add(key)
+        while self.max_items and len(self.entries) > self.max_items:
+            old, old_sig = self.entries.popitem(last=False)
+            if old_sig is None:
+                continue
+            for band in _bands(old_sig):
+                bucket = self.buckets[band]
+                bucket.discard(old)
+                if not bucket:
+                    del self.buckets[band]
+
+    def to_bytes(self) -> bytes:
+        return b"".join(self.RECORD.pack(key, sig or _NO_SIG) for key, sig in self.entries.items())
+
+    def load_bytes(self, data: bytes) -> None:
+        for key, sig in self.RECORD.iter_unpack(data[:len(data) - len(data) % self.RECORD.size]):
+            self.add(key, None if sig == _NO_SIG else sig)
+
+
+@functools.lru_cache(maxsize=NEWS_FINGERPRINT_CACHE)
+def article_fingerprint(a: Article) -> Tuple[int, Optional[bytes]]:
+    return url_key(a.link), minhash(a.title)
+
+
+def dedupe_feeds(feeds: Dict[str, Optional[List[Article]]], seen: Optional[DedupIndex] = None) -> Dict[str, Optional[List[Article]]]:
+    """Bỏ bài trùng giữa các nguồn (nguồn đứng trước được giữ) và bài đã có trong `seen`.
+
+    Nguồn mà mọi bài đều bị loại sẽ không còn trong kết quả.
+    """
+    batch = DedupIndex()
+    out: Dict[str, Optional[List[Article]]] = {}
+    for src, items in feeds.items():
+        if not items:
+            out[src] = items
+            continue
+        kept = []
+        for a in items:
+            key, sig = article_fingerprint(a)
+            if batch.contains(key, sig) or (seen is not None and seen.contains(key, sig)):
+                continue
+            batch.add(key, sig)
+            kept.append(a)
+        if kept:
+            out[src] = kept
+    return out
+
+
+class SeenNews:
+    """Các bài đã gửi theo từng khung giờ báo cáo (mỗi khung một DedupIndex), lưu ở NEWS_SEEN_FILE.
+
+    Khung nào chỉ so với bài khung đó đã gửi, để các khung sau trong ngày không mất
+    tin. Đọc lại khi mtime file đổi (replica leader vừa ghi), giống ConfigStore.
+    """
+
+    MAGIC = b"GHSEEN2\n"
+    HEADER = struct.Struct("<HI")   # độ dài tên khung, số bản ghi
+
+    def __init__(self, path: str, max_items: int):
+        self.path = path
+        self.max_items = max_items
+        self.indexes: Dict[str, DedupIndex] = {}
+        self.mtime: Optional[int] = None
+        self.checked = float("-inf")
+
+    def _stat(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _parse(self, data: bytes) -> Dict[str, DedupIndex]:
+        indexes: Dict[str, DedupIndex] = {}
+        if not data.startswith(self.MAGIC):
+            # file cũ: một index chung, làm gốc cho các khung chưa có index riêng
+            indexes[""] = DedupIndex(self.max_items)
+            indexes[""].load_bytes(data)
+            return indexes
+        pos = len(self.MAGIC)
+        record = DedupIndex.RECORD.size
+        while pos + self.HEADER.size <= len(data):
+            key_len, count = self.HEADER.unpack_from(data, pos)
+            pos += self.HEADER.size
+            key = data[pos:pos + key_len].decode()
+            pos += key_len
+            indexes[key] = DedupIndex(self.max_items)
+            indexes[key].load_bytes(data[pos:pos + count * record])
+            pos += count * record
+        return indexes
+
+    def _dump(self) -> bytes:
+        out = [self.MAGIC]
+        for key, index in self.indexes.items():
+            name = key.encode()
+            out += [self.HEADER.pack(len(name), len(index)), name, index.to_bytes()]
+        return b"".join(out)
+
+    def _reload(self) -> None:
+        now = time.monotonic()
+        if now - self.checked < CONFIG_RECHECK:
+            return
+        self.checked = now
+        mtime = self._stat()
+        if mtime is not None and mtime != self.mtime:
+            try:
+                with open(self.path, "rb") as f:
+                    data = f.read()
+                self.indexes, self.mtime = self._parse(data), mtime
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning("Không đọc được %s: %s", self.path, e)
+
+    def get(self, slot: str) -> DedupIndex:
+        self._reload()
+        index = self.indexes.get(slot)
+        if index is None:
+            index = self.indexes[slot] = DedupIndex(self.max_items)
+            if "" in self.indexes:
+                index.load_bytes(self.indexes[""].to_bytes())
+        return index
+
+    async def mark(self, slot: str, articles: List[Article], live: Collection[str]) -> None:
+        """Ghi nhận bài khung `slot` vừa gửi; bỏ index của các khung không còn trong `live`"""
+        index = self.get(slot)
+        for a in articles:
+            index.add(*article_fingerprint(a))
+        self.indexes = {k: v for k, v in self.indexes.items() if not k or k in live}
+        await asyncio.to_thread(atomic_write_bytes, self.path, self._dump())
+        self.mtime = self._stat()
+
+
+NEWS_SEEN = SeenNews(NEWS_SEEN_FILE, NEWS_SEEN_MAX)
+
+
+# ===== COINGECKO CLIENT =====
+# Mọi lời gọi CoinGecko đi qua đây: ngân sách request/phút (token bucket, chừa
+# phần cho lệnh người dùng), retry backoff có jitter, tôn trọng Retry-After và
+# circuit breaker trả lời ngay bằng dữ liệu cũ (last-known-good) khi upstream lỗi.
+COINGECKO_API = os.getenv("COINGECKO_API", "https://api.coingecko.com/api/v3")
+COINGECKO_RPM = int(os.getenv("COINGECKO_RPM", "25"))   # free tier ~30 call/phút
+CG_HIGH_RESERVE = 3            # token luôn để dành cho lệnh người dùng
+CG_HIGH_WAIT = 5               # giây tối đa lệnh người dùng chờ ngân sách
+CG_LOW_WAIT = 120              # giây tối đa tác vụ nền chờ, quá thì bỏ
+CG_MAX_RETRIES = 2
+CG_BACKOFF_BASE = 0.5          # giây, backoff = uniform(0, base * 2^n)
+CG_MAX_RETRY_DELAY = 5         # Retry-After dài hơn thì mở circuit thay vì chờ
+CG_BREAKER_THRESHOLD = 5       # số lỗi liên tiếp để mở circuit
+CG_BREAKER_COOLDOWN = 30       # giây, nhân đôi mỗi lần probe thất bại
+CG_BREAKER_MAX_COOLDOWN = 600
+CG_LAST_GOOD_MAX = 256
+# tải hàng loạt của tác vụ nền: coin index đã là bản dự phòng, không giữ JSON thô
+CG_NO_FALLBACK = ("/coins/list", "/coins/markets?vs_currency=usd&order=market_cap_desc&per_page=")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, reserve: float = 0.0) -> bool:
+        """Lấy một token nếu còn lớn hơn `reserve` token dự trữ, không chờ"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= 1 + reserve:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, reserve: float = 0.0) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        return max(self.paused_until - now, (1 + reserve - self.tokens) / self.rate, 0.0)
+
+    async def acquire(self) -> None:
+        while not self.try_acquire():
+            await asyncio.sleep(self.wait_time())
+
+
+class UpstreamBusy(Exception):
+    """CoinGecko quá tải / circuit đang mở và không có dữ liệu dự phòng"""
+
+
+class CGResponse(NamedTuple):
+    data: Any
+    stale: bool = False        # True: dữ liệu last-known-good do upstream lỗi
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+class CoinGeckoClient:
+    def __init__(self, base: str, rpm: int):
+        self.base = base
+        self.bucket = TokenBucket(rpm / 60.0, max(1.0, rpm / 6.0))
+        self.failures = 0
+        self.open_until = 0.0
+        self.cooldown = CG_BREAKER_COOLDOWN
+        self.probing = False
+        self.last_good: "OrderedDict[str, Any]" = OrderedDict()
+        self.stats = {"calls": 0, "retries": 0, "shed": 0, "stale": 0, "trips": 0}
+
+    @property
+    def is_open(self) -> bool:
+        return time.monotonic() < self.open_until
+
+    def _fallback(self, path: str, reason: str) -> CGResponse:
+        if path in self.last_good:
+            self.stats["stale"] += 1
+            return CGResponse(self.last_good[path], True)
+        raise UpstreamBusy(reason)
+
+    def _trip(self, seconds: Optional[float] = None) -> None:
+        self.open_until = time.monotonic() + max(seconds or 0.0, self.cooldown)
+        self.cooldown = min(self.cooldown * 2, CG_BREAKER_MAX_COOLDOWN)
+        self.stats["trips"] += 1
+        logger.warning("CoinGecko circuit mở trong %.0fs.", self.open_until - time.monotonic())
+
+    def _remember(self, path: str, data: Any) -> None:
+        self.failures = 0
+        self.cooldown = CG_BREAKER_COOLDOWN
+        if path.startswith(CG_NO_FALLBACK):
+            return
+        self.last_good[path] = data
+        self.last_good.move_to_end(path)
+        while len(self.last_good) > CG_LAST_GOOD_MAX:
+            self.last_good.popitem(last=False)
+
+    async def _take_token(self, priority: str) -> bool:
+        high = priority == "high"
+        reserve = 0.0 if high else min(CG_HIGH_RESERVE, self.bucket.capacity - 1)
+        deadline = time.monotonic() + (CG_HIGH_WAIT if high else CG_LOW_WAIT)
+        while not self.bucket.try_acquire(reserve):
+            wait = self.bucket.wait_time(reserve)
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+    async def get(self, path: str, priority: str = "high") -> CGResponse:
+        """GET {base}{path}; priority "high" cho lệnh người dùng, "low" cho tác vụ nền.
+
+        Raise UpstreamBusy khi không lấy được và không có bản cũ.
+        """
+        if self.is_open:
+            return self._fallback(path, "circuit open")
+        probe = self.failures >= CG_BREAKER_THRESHOLD   # half-open: chỉ một request thử
+        if probe:
+            if self.probing:
+                return self._fallback(path, "circuit half-open")
+            self.probing = True
+        try:
+            err: Any = None
+            for attempt in range(1 if probe else CG_MAX_RETRIES + 1):
+                if not await self._take_token(priority):
+                    self.stats["shed"] += 1
+                    return self._fallback(path, "rate budget exhausted")
+                self.stats["calls"] += 1
+                if attempt:
+                    self.stats["retries"] += 1
+                retry_after = None
+                try:
+                    async with get_session().get(self.base + path, timeout=http_timeout("coingecko")) as resp:
+                        if resp.status == 429 or resp.status >= 500:
+                            retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                            err = f"HTTP {resp.status}"
+                        elif resp.status >= 400:
+                            logger.warning("CoinGecko %s: HTTP %d", path, resp.status)
+                            return CGResponse({})
+                        else:
+                            data = await resp.json(content_type=None)
+                            self._remember(path, data)
+                            return CGResponse(data)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                    err = repr(e)
+                self.failures += 1
+                logger.warning("CoinGecko %s lỗi (lần %d): %s", path, attempt + 1, err)
+                if retry_after is not None:
+                    self.bucket.pause(retry_after)
+                if probe or self.failures >= CG_BREAKER_THRESHOLD or (retry_after or 0) > CG_MAX_RETRY_DELAY:
+                    self._trip(retry_after)
+                    break
+                if attempt < CG_MAX_RETRIES:
+                    await asyncio.sleep(retry_after if retry_after is not None else random.uniform(0, CG_BACKOFF_BASE * 2 ** attempt))
+            return self._fallback(path, str(err))
+        finally:
+            if probe:
+                self.probing = False
+
+
+COINGECKO = CoinGeckoClient(COINGECKO_API, COINGECKO_RPM)
+
+
+async def cg_data(path: str, priority: str = "high") -> Any:
+    """Dữ liệu CoinGecko hoặc None (bận / lỗi) — cho các chỗ chấp nhận dữ liệu cũ"""
+    try:
+        return (await COINGECKO.get(path, priority)).data
+    except UpstreamBusy as e:
+        logger.warning("CoinGecko %s: %s", path, e)
+        return None
+
+
+# ===== COIN INDEX =====
+# /coins/list (>15k coin) được nạp một lần mỗi giờ thành các index hash; tie-break
+# symbol trùng bằng market_cap_rank tính sẵn nên /price không phải gọi /search.
+COIN_REFRESH_INTERVAL = 3600   # giây
+COIN_RETRY_INTERVAL = 60       # giây, thử lại sớm hơn khi chưa có index
+COIN_RANK_PAGES = 4            # 4 x 250 coin đầu theo vốn hóa để xếp hạng
+COIN_RANK_PAGE_SIZE = 250
+COIN_NO_RANK = 10**9
+
+
+class Coin(NamedTuple):
+    id: str
+    symbol: str
+    name: str
+    rank: int
+
+
+class CoinIndex:
+    __slots__ = ("by_id", "by_symbol", "by_name", "ranked", "keys", "key_coins")
+
+    def __init__(self, coins: List[Coin]):
+        self.by_id: Dict[str, Coin] = {}
+        self.by_symbol: Dict[str, Coin] = {}
+        self.by_name: Dict[str, Coin] = {}
+        for c in coins:
+            self.by_id.setdefault(c.id, c)
+            for index, key in ((self.by_symbol, c.symbol), (self.by_name, c.name.lower())):
+                best = index.get(key)
+                if best is None or c.rank < best.rank:
+                    index[key] = c
+        self.ranked: List[Coin] = sorted((c for c in self.by_id.values() if c.rank < COIN_NO_RANK), key=lambda c: c.rank)
+        # mảng khóa (symbol / tên / id) đã sắp xếp cho tra tiền tố bằng bisect
+        pairs = sorted({(key, c) for c in self.by_id.values() for key in (c.symbol, c.name.lower(), c.id) if key})
+        self.keys: List[str] = [k for k, _ in pairs]
+        self.key_coins: List[Coin] = [c for _, c in pairs]
+
+    @classmethod
+    def build(cls, data: List[Any], ranks: Dict[str, int]) -> "CoinIndex":
+        intern = sys.intern
+        coins = []
+        for c in data:
+            if not isinstance(c, dict) or not c.get("id"):
+                continue
+            cid = intern(str(c["id"]).lower())
+            coins.append(Coin(
+                cid,
+                intern(str(c.get("symbol") or "").lower()),
+                intern(str(c.get("name") or cid)),
+                ranks.get(cid, COIN_NO_RANK),
+            ))
+        return cls(coins)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def resolve(self, query: str) -> Optional[Coin]:
+        q = query.strip().lower()
+        return self.by_id.get(q) or self.by_symbol.get(q) or self.by_name.get(q)
+
+    def complete(self, prefix: str, limit: int = 5) -> List[Coin]:
+        """Coin có symbol / tên / id bắt đầu bằng `prefix`: khớp chính xác trước, rồi theo vốn hóa"""
+        q = prefix.strip().lower()
+        if not q:
+            return self.ranked[:limit]
+        lo = bisect.bisect_left(self.keys, q)
+        hi = bisect.bisect_left(self.keys, q + "\uffff", lo)
+        matches = {c.id: c for c in self.key_coins[lo:hi]}
+        best = heapq.nsmallest(limit, matches.values(), key=lambda c: c.rank)
+        exact = self.resolve(q)
+        if exact is not None:
+            best = [exact] + [c for c in best if c.id != exact.id][:limit - 1]
+        return best
+
+
+async def refresh_coin_index() -> None:
+    """Tải danh sách coin + thứ hạng, dựng index mới rồi thay thế nguyên khối"""
+    data, *pages = await asyncio.gather(
+        cg_data("/coins/list", "low"),
+        *(
+            cg_data(f"/coins/markets?vs_currency=usd&order=market_cap_desc&per_page={COIN_RANK_PAGE_SIZE}&page={p}", "low")
+            for p in range(1, COIN_RANK_PAGES + 1)
+        ),
+    )
+    if not isinstance(data, list) or not data:
+        logger.warning("Không tải được danh sách coin, giữ index cũ.")
+        return
+    ranks: Dict[str, int] = {}
+    for page in pages:
+        for c in page if isinstance(page, list) else []:
+            if isinstance(c, dict) and c.get("id") and c.get("market_cap_rank"):
+                ranks[str(c["id"]).lower()] = int(c["market_cap_rank"])
+    # trang xếp hạng là low priority nên bị bỏ đầu tiên khi hết ngân sách:
+    # giữ thứ hạng cũ cho khoảng của trang lỗi thay vì dựng index không có hạng
+    failed = [p for p, page in enumerate(pages, 1) if not isinstance(page, list)]
+    old = COIN_CACHE["index"]
+    if failed:
+        if old is not None:
+            for c in old.ranked:
+                if (c.rank - 1) // COIN_RANK_PAGE_SIZE + 1 in failed:
+                    ranks.setdefault(c.id, c.rank)
+        if not ranks and old is not None:
+            logger.warning("Không tải được thứ hạng coin, giữ index cũ và thử lại sau %ds.", COIN_RETRY_INTERVAL)
+            COIN_CACHE["partial"] = True
+            return
+        logger.warning("Thiếu %d/%d trang thứ hạng coin, sẽ thử lại sau %ds.", len(failed), len(pages), COIN_RETRY_INTERVAL)
+    index = await asyncio.to_thread(CoinIndex.build, data, ranks)
+    COIN_CACHE["index"] = index
+    COIN_CACHE["last_update"] = int(time.time())
+    COIN_CACHE["partial"] = bool(failed)
+    METRICS.inc("bot_coin_index_refresh_total")
+    logger.info("Coin index: %d coin, %d có thứ hạng.", len(index), len(ranks))
+    await share_cache("coins")
+
+
+def _dump_coins() -> Optional[Dict[str, Any]]:
+    index = COIN_CACHE["index"]
+    if index is None:
+        return None
+    return {"coins": [list(c) for c in index.by_id.values()], "updated": COIN_CACHE["last_update"]}
+
+
+def _build_index(rows: List[List[Any]]) -> CoinIndex:
+    intern = sys.intern
+    return CoinIndex([Coin(intern(cid), intern(sym), intern(name), rank) for cid, sym, name, rank in rows])
+
+
+async def _load_coins(obj: Dict[str, Any]) -> None:
+    """Dựng index nền; get_coin_index chờ đúng task này (single-flight) thay vì tải lại"""
+    async def build() -> None:
+        COIN_CACHE["index"] = await asyncio.to_thread(_build_index, obj["coins"])
+        COIN_CACHE["last_update"] = obj["updated"]
+
+    COIN_CACHE["refresh"] = asyncio.create_task(build())
+
+
+warm_cache("coins", _dump_coins, _load_coins)
+
+
+def _coin_refresh() -> asyncio.Task:
+    """Single-flight: mọi lời gọi đồng thời dùng chung một lần refresh"""
+    task = COIN_CACHE["refresh"]
+    if task is None or task.done():
+        task = COIN_CACHE["refresh"] = asyncio.create_task(refresh_coin_index())
+    return task
+
+
+async def get_coin_index() -> Optional[CoinIndex]:
+    if COIN_CACHE["index"] is None:
+        await asyncio.shield(_coin_refresh())
+    return COIN_CACHE["index"]
+
+
+async def coin_index_task(app):
+    """Tác vụ nền làm mới coin index mỗi giờ (index dựng từ snapshot chỉ tải lại khi đã cũ)"""
+    pending = COIN_CACHE["refresh"]   # index đang dựng từ snapshot
+    while True:
+        try:
+            await (pending if pending is not None else _coin_refresh())
+        except Exception as e:
+            logger.warning("Lỗi làm mới coin index: %s", e)
+        if COIN_CACHE["index"] is None or COIN_CACHE["partial"]:
+            await asyncio.sleep(COIN_RETRY_INTERVAL)
+        else:
+            await asyncio.sleep(max(0.0, COIN_CACHE["last_update"] + COIN_REFRESH_INTERVAL - time.time()))
+        pending = None
+
+
+# ===== QUOTE CACHE =====
+# Giá theo coin id, TTL ngắn; các lượt miss đồng thời cùng coin dùng chung một
+# request simple/price (single-flight), nhiều coin được gộp vào một lần gọi.
+QUOTE_TTL = 10                 # giây
+QUOTE_CACHE_MAX = 5000
+QUOTE_CACHE: Dict[str, Tuple[float, Dict[str, float]]] = {}
+QUOTE_INFLIGHT: Dict[str, asyncio.Task] = {}
+
+
+async def _fetch_quotes(ids: List[str], priority: str = "high") -> Dict[str, Dict[str, float]]:
+    resp = await COINGECKO.get(f"/simple/price?ids={','.join(ids)}&vs_currencies=usd&include_24hr_change=true", priority)
+    res = resp.data
+    if not isinstance(res, dict):
+        return {}
+    if resp.stale:
+        return {cid: dict(res[cid], stale=True) for cid in ids if isinstance(res.get(cid), dict)}
+    now = time.monotonic()
+    if len(QUOTE_CACHE) > QUOTE_CACHE_MAX:
+        for cid in [k for k, (ts, _) in QUOTE_CACHE.items() if now - ts >= QUOTE_TTL]:
+            del QUOTE_CACHE[cid]
+    out = {}
+    for cid in ids:
+        q = res.get(cid)
+        if isinstance(q, dict) and q.get("usd") is not None:
+            QUOTE_CACHE[cid] = (now, q)
+            out[cid] = q
+    return out
+
+
+async def get_quotes(ids: List[str], priority: str = "high") -> Dict[str, Dict[str, float]]:
+    """Trả về {coin_id: {"usd": .., "usd_24h_change": ..}} cho các coin lấy được giá.
+
+    Khi CoinGecko bận, dùng giá đã hết hạn trong cache (đánh dấu "stale"); nếu
+    không có giá nào thì raise UpstreamBusy.
+    """
+    now = time.monotonic()
+    result: Dict[str, Dict[str, float]] = {}
+    waits: Dict[str, asyncio.Task] = {}
+    missing = []
+    for cid in dict.fromkeys(ids):
+        hit = QUOTE_CACHE.get(cid)
+        if hit and now - hit[0] < QUOTE_TTL:
+            result[cid] = hit[1]
+            cache_hit("quote", "hit")
+        elif cid in QUOTE_INFLIGHT:
+            waits[cid] = QUOTE_INFLIGHT[cid]
+            cache_hit("quote", "coalesced")
+        else:
+            missing.append(cid)
+            cache_hit("quote", "miss")
+    if missing:
+        task = asyncio.create_task(_fetch_quotes(missing, priority))
+        for cid in missing:
+            QUOTE_INFLIGHT[cid] = waits[cid] = task
+
+        def _done(t: asyncio.Task, ids: Tuple[str, ...] = tuple(missing)) -> None:
+            for cid in ids:
+                if QUOTE_INFLIGHT.get(cid) is t:
+                    del QUOTE_INFLIGHT[cid]
+
+        task.add_done_callback(_done)
+    busy: Optional[UpstreamBusy] = None
+    for task in set(waits.values()):
+        try:
+            data = await asyncio.shield(task)
+        except UpstreamBusy as e:
+            busy, data = e, {}
+        for cid, t in waits.items():
+            if t is not task:
+                continue
+            if cid in data:
+                result[cid] = data[cid]
+            elif busy is not None and cid in QUOTE_CACHE:
+                result[cid] = dict(QUOTE_CACHE[cid][1], stale=True)
+    if busy is not None and not result:
+        raise busy
+    return result
+
+
+def format_change(q: Dict[str, float]) -> str:
+    change = q.get("usd_24h_change")
+    out = f" ({change:+.2f}%)" if isinstance(change, (int, float)) else ""
+    return out + (" ⚠️ giá cũ" if q.get("stale") else "")
+
+
+# ===== COMMAND HANDLERS =====
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not (is_registered(user.id) or is_admin(user.id)):
+        await update.message.reply_text("🔒 Bạn chưa được kích hoạt. Dùng /dangky để gửi yêu cầu.")
+        return
+    await update.message.reply_text(
+        f"👋 Chào {user.first_name}! Tôi là @girlhonghot – trợ lý crypto của bạn 💖"
+    )
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = (
+        "💡 *Hướng dẫn sử dụng:*\n"
+        "• /start – Bắt đầu trò chuyện\n"
+        "• /dangky – Gửi yêu cầu đăng ký\n"
+        "• /price <coin> [coin ...] – Xem giá coin\n"
+        "• /top – Top 10 coin theo vốn hóa\n"
+        "• /chart <coin> [7d] – Biểu đồ giá\n"
+        "• /alert <coin> > <giá> – Cảnh báo giá (/alerts, /delalert)\n"
+        "• /news – Tin tức RSS\n"
+        "• /report – Báo cáo thủ công\n"
+        "• /mytime – Giờ nhận báo cáo riêng\n"
+        "• /help – Hướng dẫn\n"
+        "• @girlhonghot <coin> – Tra giá, tin ngay trong mọi chat\n"
+        "👑 *Admin:* /them, /xoa, /listuser, /addnews, /delnews, /settime, /stats"
+    )
+    await update.message.reply_text(text, parse_mode="Markdown")
+
+
+# ===== USER MANAGEMENT =====
+async def dangky(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user.id in USERS:
+        await update.message.reply_text("✅ Bạn đã được kích hoạt!")
+        return
+    msg = f"📩 *YÊU CẦU ĐĂNG KÝ*\n👤 @{user.username or 'Không có'}\n🆔 `{user.id}`"
+    if ADMIN_ID:
+        try:
+            await context.bot.send_message(int(ADMIN_ID), msg, parse_mode="Markdown")
+        except Exception as e:
+            logger.warning("Lỗi gửi tin admin: %s", e)
+    await update.message.reply_text("🕐 Đã gửi yêu cầu đến admin, vui lòng chờ duyệt 💬")
+
+
+async def them(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("🚫 Không có quyền.")
+        return
+    if not context.args:
+        await update.message.reply_text("❌ Sai cú pháp: /them <id>")
+        return
+    uid = context.args[0]
+    try:
+        user_info = await context.bot.get_chat(uid)
+        name = user_info.username or user_info.first_name or "User"
+        await USERS.add(uid, name)
+        await SCHEDULER.reload()
+        await update.message.reply_text(f"✅ Đã kích hoạt {name} ({uid})")
+        try:
+            await context.bot.send_message(int(uid), "🎉 Bạn đã được kích hoạt! 💖")
+        except Exception:
+            pass
+    except Exception as e:
+        await update.message.reply_text(f"❌ Lỗi: {e}")
+
+
+async def xoa(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("🚫 Không có quyền.")
+        return
+    if not context.args:
+        await update.message.reply_text("❌ Sai cú pháp: /xoa <id>")
+        return
+    uid = context.args[0]
+    if not await USERS.remove(uid):
+        await update.message.reply_text("❌ Không tìm thấy user này.")
+        return
+    await SCHEDULER.reload()
+    await update.message.reply_text(f"🗑️ Đã xóa {uid}")
+
+
+async def listuser(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("🚫 Không có quyền.")
+        return
+    if not len(USERS):
+        await update.message.reply_text("📭 Chưa có người dùng nào.")
+        return
+    msg = "👥 *Danh sách người dùng:*\n\n"
+    for k, v in USERS.items():
+        msg += f"• {v} – `{k}`\n"
+    await update.message.reply_text(msg, parse_mode="Markdown")
+
+
+# ===== NEWS HANDLERS =====
+async def news(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cfg = load_config()
+    msg = "📰 <b>TIN TỨC CRYPTO MỚI NHẤT</b>\n\n"
+    feeds = dedupe_feeds(await get_news(cfg))
+    for src, items in feeds.items():
+        if items is None:
+            msg += f"⏱️ Quá thời gian chờ: {src}\n\n"
+            continue
+        if not items:
+            msg += f"⚠️ Không tìm thấy tin nào từ {src}\n\n"
+            continue
+        msg += render_feed_items(items, 5)
+        msg += "\n"
+    await update.message.reply_text(msg, parse_mode="HTML", disable_web_page_preview=False)
+
+
+async def addnews(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("🚫 Không có quyền.")
+        return
+    if not context.args:
+        await update.message.reply_text("⚙️ Dùng: /addnews <url>")
+        return
+    url = context.args[0]
+    async with CONFIG.edit() as cfg:
+        exists = url in cfg["news_sources"]
+        if not exists:
+            cfg["news_sources"].append(url)
+    await update.message.reply_text("⚠️ Nguồn đã tồn tại." if exists else "✅ Đã thêm nguồn tin.")
+
+
+async def delnews(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("🚫 Không có quyền.")
+        return
+    if not context.args:
+        await update.message.reply_text("⚙️ Dùng: /delnews <url>")
+        return
+    url = context.args[0]
+    async with CONFIG.edit() as cfg:
+        exists = url in cfg["news_sources"]
+        if exists:
+            cfg["news_sources"].remove(url)
+    await update.message.reply_text("🗑️ Đã xóa nguồn tin." if exists else "❌ Không có nguồn này.")
+
+
+async def listnews(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cfg = load_config()
+    msg = "🗞️ *Danh sách nguồn tin:*\n\n"
+    for s in cfg["news_sources"]:
+        msg += f"• {s}\n"
+    await update.message.reply_text(msg, parse_mode="Markdown")
+
+
+# ===== PRICE / TOP =====
+PRICE_MAX_COINS = 20
+UPSTREAM_BUSY_MSG = "⏳ CoinGecko đang quá tải, vui lòng thử lại sau ít phút."
+
+
+async def price(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_registered(update.effective_user.id):
+        await update.message.reply_text("🔒 Cần /dangky trước.")
+        return
+    if not context.args:
+        await update.message.reply_text("⚙️ Dùng: /price btc hoặc /price btc eth sol")
+        return
+    queries = list(dict.fromkeys(a.lower() for a in context.args[:PRICE_MAX_COINS]))
+
+    index = await get_coin_index()
+    matches = {q: index.resolve(q) if index is not None else None for q in queries}
+    found = [c for c in matches.values() if c]
+    if not found:
+        await update.message.reply_text("❌ Không tìm thấy coin.")
+        return
+
+    try:
+        quotes = await get_quotes([c.id for c in found])
+    except UpstreamBusy:
+        await update.message.reply_text(UPSTREAM_BUSY_MSG)
+        return
+    lines = []
+    for q, c in matches.items():
+        if c is None:
+            lines.append(f"❌ Không tìm thấy coin: {q}")
+        elif c.id in quotes:
+            lines.append(f"💰 Giá {c.name.title()} ({c.symbol.upper()}): ${quotes[c.id]['usd']:,}{format_change(quotes[c.id])}")
+        else:
+            lines.append(f"⚠️ Không lấy được giá {c.name.title()} ({c.symbol.upper()}).")
+    await update.message.reply_text("\n".join(lines))
+
+
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_registered(update.effective_user.id):
+        await update.message.reply_text("🔒 Cần /dangky trước.")
+        return
+    index = await get_coin_index()
+    ranked = index.ranked[:10] if index is not None else []
+    if not ranked:
+        await update.message.reply_text("⚠️ Lỗi dữ liệu từ API.")
+        return
+    try:
+        quotes = await get_quotes([c.id for c in ranked])
+    except UpstreamBusy:
+        await update.message.reply_text(UPSTREAM_BUSY_MSG)
+        return
+    msg = "🏆 *Top 10 Coin theo vốn hóa:*\n\n"
+    for i, c in enumerate(ranked, 1):
+        price = quotes.get(c.id, {}).get("usd")
+        price_str = f"${price:,.2f}" if isinstance(price, (int, float)) else "N/A"
+        stale = " ⚠️" if quotes.get(c.id, {}).get("stale") else ""
+        msg += f"{i}. {c.name} ({c.symbol.upper()}): {price_str}{stale}\n"
+    await update.message.reply_text(msg, parse_mode="Markdown")
+
+
+# ===== PRICE ALERTS =====
+# Cảnh báo giá một lần. Mỗi coin giữ hai mảng (target, id) đã sắp xếp cho mốc
+# "trên" và "dưới"; mỗi vòng chỉ gọi simple/price cho các coin đang được theo dõi
+# rồi dùng bisect cắt đúng phần alert đã chạm mốc — O(log n + k) mỗi coin.
+ALERTS_FILE = os.getenv("ALERTS_FILE", "alerts.json")
+ALERT_INTERVAL = 60            # giây giữa hai lần kiểm tra
+ALERT_BATCH = 250              # coin id tối đa trong một lần gọi simple/price
+ALERT_MAX_PER_CHAT = 20
+ALERT_SAVE_DELAY = 2.0         # giây, gộp nhiều thay đổi thành một lần ghi
+ALERT_SEND_RATE = 20           # tin/giây cho thông báo alert
+ALERT_SEND_BURST = 5
+ALERT_SEND_WORKERS = 4
+_ALERT_RE = re.compile(r"^(\S+?)\s*(>=|<=|>|<)\s*\$?([\d.,]+)\s*([km]?)$", re.I)
+
+
+class Alert(NamedTuple):
+    id: int
+    chat_id: str
+    coin: str           # CoinGecko id
+    symbol: str
+    op: str             # ">": giá >= target, "<": giá <= target
+    target: float
+
+
+class AlertBook:
+    """Danh sách alert trong RAM (theo id, chat, coin), lưu ra ALERTS_FILE có debounce"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.by_id: Dict[int, Alert] = {}
+        self.by_chat: Dict[str, Dict[int, Alert]] = {}
+        self.keys: Dict[Tuple[str, str, str, float], int] = {}   # chống trùng
+        self.sides: Dict[str, Dict[str, List[Tuple[float, int]]]] = {">": {}, "<": {}}
+        self.sending: set = set()   # id alert đã chạm mốc, thông báo đang chờ gửi
+        self.next_id = 1
+        self._save_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("File alert %s hỏng, bỏ qua: %s", self.path, e)
+            return
+        self._index(state.get("alerts", []))
+        self.next_id = max(state.get("next_id", 1), max(self.by_id, default=0) + 1)
+        logger.info("Đã nạp %d alert trên %d coin.", len(self), len(self.coins()))
+
+    def _index(self, rows) -> None:
+        self.by_id, self.by_chat, self.keys = {}, {}, {}
+        self.sides = {">": {}, "<": {}}
+        for row in rows:
+            a = Alert(*row)
+            self._link(a)
+            self.sides[a.op].setdefault(a.coin, []).append((a.target, a.id))
+        for lst in (*self.sides[">"].values(), *self.sides["<"].values()):
+            lst.sort()
+
+    def _link(self, a: Alert) -> None:
+        self.by_id[a.id] = a
+        self.by_chat.setdefault(a.chat_id, {})[a.id] = a
+        self.keys[(a.chat_id, a.coin, a.op, a.target)] = a.id
+
+    def _unlink(self, a: Alert) -> None:
+        del self.by_id[a.id]
+        chat = self.by_chat[a.chat_id]
+        del chat[a.id]
+        if not chat:
+            del self.by_chat[a.chat_id]
+        del self.keys[(a.chat_id, a.coin, a.op, a.target)]
+
+    def _drop_level(self, a: Alert) -> None:
+        lst = self.sides[a.op][a.coin]
+        i = bisect.bisect_left(lst, (a.target, a.id))
+        if i < len(lst) and lst[i] == (a.target, a.id):
+            del lst[i]
+        if not lst:
+            del self.sides[a.op][a.coin]
+
+    async def add(self, chat_id: Any, coin: Coin, op: str, target: float) -> Tuple[Alert, bool]:
+        """Thêm alert; trả về (alert, False) nếu chat đã có đúng alert này"""
+        chat_id = str(chat_id)
+        existing = self.keys.get((chat_id, coin.id, op, target))
+        if existing is not None:
+            return self.by_id[existing], False
+        a = Alert(self.next_id, chat_id, coin.id, coin.symbol, op, target)
+        self.next_id += 1
+        self._link(a)
+        bisect.insort(self.sides[op].setdefault(a.coin, []), (target, a.id))
+        self.save()
+        return a, True
+
+    async def remove(self, aid: int) -> Optional[Alert]:
+        a = self.by_id.get(aid)
+        if a is None:
+            return None
+        self._unlink(a)
+        self._drop_level(a)
+        self.save()
+        return a
+
+    def for_chat(self, chat_id: Any) -> List[Alert]:
+        return sorted(self.by_chat.get(str(chat_id), {}).values())
+
+    def coins(self) -> List[str]:
+        return list(self.sides[">"].keys() | self.sides["<"].keys())
+
+    def triggered(self, coin: str, price: float) -> List[Alert]:
+        """Các alert của coin đã chạm mốc ở giá `price` và chưa đang chờ gửi.
+
+        Alert chỉ bị xóa khi thông báo đã gửi được (discard()); gửi lỗi thì
+        release() để vòng kiểm tra sau báo lại.
+        """
+        fired = [a for a in self._hits(coin, price) if a.id not in self.sending]
+        self.sending.update(a.id for a in fired)
+        return fired
+
+    def release(self, alerts: List[Alert]) -> None:
+        self.sending.difference_update(a.id for a in alerts)
+
+    async def discard(self, alerts: List[Alert]) -> None:
+        """Xóa các alert (nếu còn) sau khi đã báo cho người dùng"""
+        self._forget(alerts)
+        if alerts:
+            self.save()
+
+    def _forget(self, alerts: List[Alert]) -> None:
+        """Bỏ alert khỏi index RAM (bỏ qua alert không còn, vd. vừa bị /delalert)"""
+        for a in alerts:
+            if self.by_id.get(a.id) == a:
+                self._unlink(a)
+                self._drop_level(a)
+
+    def _hits(self, coin: str, price: float) -> List[Alert]:
+        """Mọi alert của coin đã chạm mốc ở giá `price`"""
+        above = self.sides[">"].get(coin, [])
+        below = self.sides["<"].get(coin, [])
+        hits = above[:bisect.bisect_right(above, (price, float("inf")))]
+        hits += below[bisect.bisect_left(below, (price, 0)):]
+        return [self.by_id[aid] for _, aid in hits]
+
+    def _snapshot(self) -> Dict[str, Any]:
+        return {"next_id": self.next_id, "alerts": [list(a) for a in self.by_id.values()]}
+
+    async def _save_later(self) -> None:
+        await asyncio.sleep(ALERT_SAVE_DELAY)
+        self._save_task = None
+        await asyncio.to_thread(atomic_write_json, self.path, self._snapshot(), None)
+
+    def save(self) -> None:
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.get_running_loop().create_task(self._save_later())
+
+    async def flush(self) -> None:
+        if self._save_task is not None and not self._save_task.done():
+            self._save_task.cancel()
+            self._save_task = None
+            atomic_write_json(self.path, self._snapshot(), None)
+
+
+class SqliteAlertBook(AlertBook):
+    """Alert trong bảng SQLite dùng chung (COORD_DB), ghi thẳng xuống DB.
+
+    Index RAM giữ nguyên cấu trúc của AlertBook và được dựng lại khi replica
+    khác sửa bảng (version "alerts" đổi). Lần đầu chuyển alert từ ALERTS_FILE.
+    """
+
+    def __init__(self, db_path: str, legacy_path: str):
+        super().__init__(legacy_path)
+        self.db_path = db_path
+        self.lock = asyncio.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.version = 0
+        self.checked = 0.0
+
+    def load(self) -> None:
+        self.conn = open_shared_db(self.db_path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS alerts (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id TEXT NOT NULL, "
+                "coin TEXT NOT NULL, symbol TEXT NOT NULL, op TEXT NOT NULL, target REAL NOT NULL, "
+                "UNIQUE (chat_id, coin, op, target))"
+            )
+        if self.conn.execute("SELECT 1 FROM alerts LIMIT 1").fetchone() is None:
+            super().load()
+            if self.by_id:
+                self._write(
+                    "INSERT OR IGNORE INTO alerts (id, chat_id, coin, symbol, op, target) VALUES (?, ?, ?, ?, ?, ?)",
+                    [tuple(a) for a in self.by_id.values()],
+                )
+                logger.info("Đã chuyển %d alert từ %s sang %s", len(self), self.path, self.db_path)
+        self._reload()
+        logger.info("Đã nạp %d alert trên %d coin.", len(self), len(self.coins()))
+
+    def _reload(self) -> None:
+        self.version = table_version(self.conn, "alerts")
+        self._index(self.conn.execute("SELECT id, chat_id, coin, symbol, op, target FROM alerts"))
+
+    def sync(self) -> None:
+        now = time.monotonic()
+        if self.conn is None or now - self.checked < CONFIG_RECHECK:
+            return
+        self.checked = now
+        try:
+            if table_version(self.conn, "alerts") != self.version:
+                self._reload()
+        except sqlite3.Error as e:
+            logger.warning("Lỗi đọc lại bảng alerts: %s", e)
+
+    def _write(self, sql: str, rows: List[Tuple[Any, ...]]) -> int:
+        """Ghi trong một transaction, tăng version bảng; trả về số dòng bị đổi"""
+        with self.conn:
+            count = self.conn.executemany(sql, rows).rowcount
+            if count <= 0:
+                return 0
+            self.conn.execute(_VERSION_BUMP, ("alerts",))
+            version = table_version(self.conn, "alerts")
+        # chỉ có ghi của mình xen vào -> index RAM vẫn khớp
+        if version == self.version + 1:
+            self.version = version
+        return count
+
+    def _insert(self, key: Tuple[str, str, str, float], symbol: str) -> Optional[int]:
+        """INSERT rồi lấy id (chạy trong thread); None nếu alert đã có trong bảng"""
+        if not self._write(
+            "INSERT OR IGNORE INTO alerts (chat_id, coin, op, target, symbol) VALUES (?, ?, ?, ?, ?)",
+            [(*key, symbol)],
+        ):
+            return None
+        (aid,) = self.conn.execute(
+            "SELECT id FROM alerts WHERE chat_id = ? AND coin = ? AND op = ? AND target = ?", key
+        ).fetchone()
+        return aid
+
+    async def add(self, chat_id: Any, coin: Coin, op: str, target: float) -> Tuple[Alert, bool]:
+        async with self.lock:
+            self.sync()
+            key = (str(chat_id), coin.id, op, target)
+            existing = self.keys.get(key)
+            if existing is not None:
+                return self.by_id[existing], False
+            aid = await asyncio.to_thread(self._insert, key, coin.symbol)
+            if aid is None:  # replica khác vừa thêm đúng alert này
+                self._reload()
+                return self.by_id[self.keys[key]], False
+            a = Alert(aid, key[0], coin.id, coin.symbol, op, target)
+            if aid not in self.by_id:
+                self._link(a)
+                bisect.insort(self.sides[op].setdefault(a.coin, []), (target, a.id))
+            return a, True
+
+    async def remove(self, aid: int) -> Optional[Alert]:
+        async with self.lock:
+            self.sync()
+            a = self.by_id.get(aid)
+            if a is not None:
+                await asyncio.to_thread(self._write, "DELETE FROM alerts WHERE id = ?", [(aid,)])
+                self._forget([a])
+            return a
+
+    def for_chat(self, chat_id: Any) -> List[Alert]:
+        self.sync()
+        return super().for_chat(chat_id)
+
+    def coins(self) -> List[str]:
+        self.sync()
+        return super().coins()
+
+    async def discard(self, alerts: List[Alert]) -> None:
+        # chỉ bỏ khỏi RAM sau khi DELETE đã commit (index có thể vừa được nạp lại)
+        async with self.lock:
+            alerts = [a for a in alerts if a.id in self.by_id]
+            if alerts:
+                await asyncio.to_thread(self._write, "DELETE FROM alerts WHERE id = ?", [(a.id,) for a in alerts])
+                self._forget(alerts)
+
+    def save(self) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+ALERTS: AlertBook = SqliteAlertBook(COORD_DB, ALERTS_FILE) if COORD_DB else AlertBook(ALERTS_FILE)
+ALERT_QUEUE: asyncio.Queue = asyncio.Queue()
+ALERT_BUCKET = TokenBucket(ALERT_SEND_RATE, ALERT_SEND_BURST)
+
+
+def parse_alert(text: str) -> Optional[Tuple[str, str, float]]:
+    """'btc > 70000' / 'eth<=2.5k' -> (coin, op, target) hoặc None"""
+    m = _ALERT_RE.match(text.strip())
+    if not m:
+        return None
+    sym, op, num, suffix = m.groups()
+    try:
+        target = float(num.replace(",", ""))
+    except ValueError:
+        return None
+    target *= {"": 1, "k": 1e3, "m": 1e6}[suffix.lower()]
+    if target <= 0:
+        return None
+    return sym.lower(), op[0], target
+
+
+def format_alert(a: Alert) -> str:
+    return f"#{a.id} {a.symbol.upper()} {'≥' if a.op == '>' else '≤'} ${a.target:,.8g}"
+
+
+async def check_alerts() -> int:
+    """Một vòng kiểm tra: gộp giá các coin đang theo dõi, đẩy thông báo vào hàng đợi gửi"""
+    coins = ALERTS.coins()
+    fired: Dict[str, List[Tuple[Alert, float]]] = {}
+    for i in range(0, len(coins), ALERT_BATCH):
+        try:
+            quotes = await get_quotes(coins[i:i + ALERT_BATCH], priority="low")
+        except UpstreamBusy as e:
+            logger.warning("Bỏ qua vòng kiểm tra alert: %s", e)
+            break
+        for cid, q in quotes.items():
+            if q.get("stale"):  # không báo dựa trên giá cũ
+                continue
+            for a in ALERTS.triggered(cid, q["usd"]):
+                fired.setdefault(a.chat_id, []).append((a, q["usd"]))
+    for chat_id, hits in fired.items():
+        lines = [
+            f"• {a.symbol.upper()} {'đã lên' if a.op == '>' else 'đã xuống'} ${p:,} (mốc {format_alert(a)})"
+            for a, p in hits
+        ]
+        ALERT_QUEUE.put_nowait((chat_id, "🔔 <b>CẢNH BÁO GIÁ</b>\n" + "\n".join(lines), [a for a, _ in hits]))
+    count = sum(len(h) for h in fired.values())
+    if count:
+        METRICS.inc("bot_alerts_triggered_total", (), count)
+    return count
+
+
+async def _alert_sender(bot) -> None:
+    while True:
+        chat_id, text, alerts = await ALERT_QUEUE.get()
+        try:
+            for attempt in range(BROADCAST_RETRIES + 1):
+                await ALERT_BUCKET.acquire()
+                try:
+                    await bot.send_message(int(chat_id), text, parse_mode="HTML")
+                    await ALERTS.discard(alerts)   # chỉ xóa khi người dùng đã nhận được
+                    break
+                except RetryAfter as e:
+                    ALERT_BUCKET.pause(_retry_after_seconds(e))
+                except Forbidden as e:
+                    logger.info("Chat %s chặn bot (%s), xóa alert.", chat_id, e)
+                    for a in ALERTS.for_chat(chat_id):
+                        await ALERTS.remove(a.id)
+                    break
+                except NetworkError as e:
+                    logger.warning("Lỗi mạng khi gửi alert cho %s (lần %d): %s", chat_id, attempt + 1, e)
+                    await asyncio.sleep(min(2 ** attempt, 30))
+        except Exception as e:
+            logger.warning("Lỗi gửi alert cho %s: %s", chat_id, e)
+        finally:
+            ALERTS.release(alerts)   # chưa gửi được: vòng kiểm tra sau báo lại
+            ALERT_QUEUE.task_done()
+
+
+async def alert_task(app):
+    """Vòng kiểm tra alert nền + worker gửi thông báo có giới hạn tốc độ"""
+    senders = [asyncio.create_task(_alert_sender(app.bot)) for _ in range(ALERT_SEND_WORKERS)]
+    try:
+        while True:
+            await asyncio.sleep(ALERT_INTERVAL)
+            if not len(ALERTS):
+                continue
+            try:
+                await check_alerts()
+            except Exception as e:
+                logger.warning("Lỗi kiểm tra alert: %s", e)
+    finally:
+        for s in senders:
+            s.cancel()
+
+
+async def alert_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_registered(update.effective_user.id):
+        await update.message.reply_text("🔒 Cần /dangky trước.")
+        return
+    parsed = parse_alert(" ".join(context.args))
+    if parsed is None:
+        await update.message.reply_text("⚙️ Dùng: /alert btc > 70000 hoặc /alert eth < 2500")
+        return
+    sym, op, target = parsed
+    chat_id = update.effective_chat.id
+    index = await get_coin_index()
+    coin = index.resolve(sym) if index is not None else None
+    if coin is None:
+        await update.message.reply_text(f"❌ Không tìm thấy coin: {sym}")
+        return
+    if len(ALERTS.for_chat(chat_id)) >= ALERT_MAX_PER_CHAT:
+        await update.message.reply_text(f"⚠️ Tối đa {ALERT_MAX_PER_CHAT} cảnh báo mỗi chat, xóa bớt bằng /delalert.")
+        return
+    a, created = await ALERTS.add(chat_id, coin, op, target)
+    if not created:
+        await update.message.reply_text(f"ℹ️ Cảnh báo này đã có: {format_alert(a)}")
+        return
+    await update.message.reply_text(f"✅ Đã đặt cảnh báo {format_alert(a)} — kiểm tra mỗi {ALERT_INTERVAL}s.")
+
+
+async def alerts_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_registered(update.effective_user.id):
+        await update.message.reply_text("🔒 Cần /dangky trước.")
+        return
+    alerts = ALERTS.for_chat(update.effective_chat.id)
+    if not alerts:
+        await update.message.reply_text("📭 Chưa có cảnh báo nào. Dùng /alert btc > 70000")
+        return
+    await update.message.reply_text("🔔 Cảnh báo đang theo dõi:\n" + "\n".join(f"• {format_alert(a)}" for a in alerts))
+
+
+async def delalert(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_registered(update.effective_user.id):
+        await update.message.reply_text("🔒 Cần /dangky trước.")
+        return
+    if not context.args:
+        await update.message.reply_text("⚙️ Dùng: /delalert <id> hoặc /delalert all")
+        return
+    mine = {a.id for a in ALERTS.for_chat(update.effective_chat.id)}
+    if context.args[0].lower() == "all":
+        ids = mine
+    else:
+        ids = {int(x) for x in (a.lstrip("#") for a in context.args) if x.isdigit()} & mine
+    if not ids:
+        await update.message.reply_text("❌ Không tìm thấy cảnh báo này.")
+        return
+    for aid in ids:
+        await ALERTS.remove(aid)
+    await update.message.reply_text(f"🗑️ Đã xóa {len(ids)} cảnh báo.")
+
+
+# ===== PRICE HISTORY =====
+# Chuỗi giá cục bộ cho các coin trong config "history_coins". Mỗi coin có ba
+# tầng 1m / 1h / 1d; mỗi tầng là ring buffer trên file mmap gồm hai cột (ts
+# uint32, giá float64), mẫu mới trong cùng bucket ghi đè giá đóng cửa — tầng thô
+# được "rollup" ngay khi ghi, không cần job gộp riêng.
+HISTORY_DIR = os.getenv("HISTORY_DIR", "history")
+HISTORY_INTERVAL = 60          # giây giữa hai lần lấy mẫu
+HISTORY_TIERS = (              # (bước giây, số mẫu giữ lại)
+    (60, 2880),                # 1 phút x 2 ngày
+    (3600, 1440),              # 1 giờ x 60 ngày
+    (86400, 3650),             # 1 ngày x 10 năm
+)
+HISTORY_BACKFILL_DAYS = 60     # lần đầu: lấy market_chart (theo giờ) để có ngay 7d/30d
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+SPARK_WIDTH = 40
+CHART_DEFAULT_RANGE = "24h"
+_RANGE_RE = re.compile(r"^(\d+)([hdwy])$")
+_RANGE_UNITS = {"h": 3600, "d": 86400, "w": 7 * 86400, "y": 365 * 86400}
+_COIN_ID_RE = re.compile(r"^[a-z0-9][a-z0-9-]*$")
+
+
+class Series:
+    """Ring buffer kích thước cố định trên mmap: header + cột ts + cột giá.
+
+    head/count luôn đọc từ header trong mmap nên replica khác trên cùng máy
+    thấy ngay mẫu mà leader vừa ghi.
+    """
+
+    HEADER = struct.Struct("<4sIII")   # magic, capacity, head (ô ghi kế tiếp), count
+    STATE = struct.Struct("<II")       # head, count — phần cuối của HEADER
+    MAGIC = b"PH01"
+
+    def __init__(self, path: str, step: int, capacity: int):
+        self.step = step
+        self.capacity = capacity
+        size = self.HEADER.size + capacity * 12
+        fresh = not os.path.exists(path)
+        self.file = open(path, "w+b" if fresh else "r+b")
+        if os.fstat(self.file.fileno()).st_size != size:
+            fresh = True
+            self.file.truncate(size)
+        self.mm = mmap.mmap(self.file.fileno(), size)
+        magic, cap, _, _ = self.HEADER.unpack_from(self.mm)
+        if fresh or magic != self.MAGIC or cap != capacity:
+            if not fresh:
+                logger.warning("Lịch sử giá %s không khớp định dạng, tạo lại.", path)
+            self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.capacity, 0, 0)
+        ts_end = self.HEADER.size + capacity * 4
+        self.ts = memoryview(self.mm)[self.HEADER.size:ts_end].cast("I")
+        self.px = memoryview(self.mm)[ts_end:].cast("d")
+
+    def _state(self) -> Tuple[int, int]:
+        return self.STATE.unpack_from(self.mm, 8)
+
+    @property
+    def count(self) -> int:
+        return self._state()[1]
+
+    def append(self, ts: float, price: float) -> None:
+        head, count = self._state()
+        bucket = int(ts) - int(ts) % self.step
+        if count:
+            last = (head - 1) % self.capacity
+            if self.ts[last] == bucket:
+                self.px[last] = price
+                return
+            if self.ts[last] > bucket:   # mẫu cũ hơn dữ liệu đã có
+                return
+        self.ts[head] = bucket
+        self.px[head] = price
+        self.STATE.pack_into(self.mm, 8, (head + 1) % self.capacity, min(count + 1, self.capacity))
+
+    def first_ts(self) -> Optional[int]:
+        head, count = self._state()
+        return self.ts[(head - count) % self.capacity] if count else None
+
+    def last(self) -> Optional[Tuple[int, float]]:
+        head, count = self._state()
+        if not count:
+            return None
+        i = (head - 1) % self.capacity
+        return self.ts[i], self.px[i]
+
+    def columns(self) -> Tuple[array, array]:
+        """Hai cột theo thứ tự thời gian (bản sao)"""
+        head, count = self._state()
+        start = (head - count) % self.capacity
+        ts, px = array("I"), array("d")
+        if start + count <= self.capacity:
+            spans = [(start, start + count)]
+        else:
+            spans = [(start, self.capacity), (0, head)]
+        for a, b in spans:
+            ts.frombytes(self.ts[a:b].tobytes())
+            px.frombytes(self.px[a:b].tobytes())
+        return ts, px
+
+    def since(self, t0: float) -> Tuple[array, array]:
+        ts, px = self.columns()
+        i = bisect.bisect_left(ts, t0)
+        return ts[i:], px[i:]
+
+    def at(self, t: float) -> Optional[float]:
+        """Giá của mẫu cuối cùng có ts <= t"""
+        ts, px = self.columns()
+        i = bisect.bisect_right(ts, t)
+        return px[i - 1] if i else None
+
+    def close(self) -> None:
+        self.ts.release()
+        self.px.release()
+        self.mm.flush()
+        self.mm.close()
+        self.file.close()
+
+
+class PriceHistory:
+    def __init__(self, root: str):
+        self.root = root
+        self.series: Dict[str, List[Series]] = {}
+
+    def _open(self, cid: str) -> List[Series]:
+        tiers = self.series.get(cid)
+        if tiers is None:
+            if not _COIN_ID_RE.match(cid):
+                raise ValueError(f"coin id không hợp lệ: {cid!r}")
+            os.makedirs(self.root, exist_ok=True)
+            tiers = self.series[cid] = [
+                Series(os.path.join(self.root, f"{cid}.{step}.bin"), step, cap) for step, cap in HISTORY_TIERS
+            ]
+        return tiers
+
+    def has(self, cid: str) -> bool:
+        if cid in self.series:
+            return True
+        return os.path.exists(os.path.join(self.root, f"{cid}.{HISTORY_TIERS[0][0]}.bin"))
+
+    def record(self, cid: str, price: float, ts: Optional[float] = None, tiers: int = 0) -> None:
+        ts = time.time() if ts is None else ts
+        for s in self._open(cid)[tiers:]:
+            s.append(ts, price)
+
+    def empty(self, cid: str) -> bool:
+        return not any(s.count for s in self._open(cid))
+
+    def points(self, cid: str, seconds: float) -> Tuple[array, array]:
+        """Mẫu trong `seconds` gần nhất từ tầng mịn nhất còn phủ được khoảng đó"""
+        t0 = time.time() - seconds
+        best: Tuple[array, array] = (array("I"), array("d"))
+        for s in self._open(cid):
+            if s.step * s.capacity < seconds:
+                continue
+            first = s.first_ts()
+            pts = s.since(t0)
+            if first is not None and first <= t0 + s.step:
+                return pts
+            if len(pts[0]) > len(best[0]):
+                best = pts
+        return best
+
+    def change(self, cid: str, seconds: float, price: float) -> Optional[float]:
+        """% thay đổi so với `seconds` trước, None nếu chưa đủ dữ liệu"""
+        if not self.has(cid):
+            return None
+        t = time.time() - seconds
+        for s in self._open(cid):
+            first = s.first_ts()
+            if first is not None and first <= t:
+                past = s.at(t)
+                return (price / past - 1) * 100 if past else None
+        return None
+
+    def close(self) -> None:
+        for tiers in self.series.values():
+            for s in tiers:
+                s.close()
+        self.series.clear()
+
+
+HISTORY = PriceHistory(HISTORY_DIR)
+
+
+def history_changes(cid: str, price: float) -> str:
+    """' · 7d +1.2% · 30d -3.4%' từ lịch sử cục bộ (rỗng nếu chưa đủ dữ liệu)"""
+    out = ""
+    for label, days in (("7d", 7), ("30d", 30)):
+        c = HISTORY.change(cid, days * 86400, price)
+        if c is not None:
+            out += f" · {label} {c:+.1f}%"
+    return out
+
+
+async def _backfill_history(cid: str) -> None:
+    data = await cg_data(f"/coins/{cid}/market_chart?vs_currency=usd&days={HISTORY_BACKFILL_DAYS}", "low")
+    points = data.get("prices") if isinstance(data, dict) else None
+    if not points:
+        return
+    for ms, p in points:
+        if isinstance(p, (int, float)):
+            HISTORY.record(cid, p, ms / 1000, tiers=1)   # dữ liệu theo giờ: bỏ tầng 1m
+    logger.info("Đã nạp %d mẫu lịch sử cho %s.", len(points), cid)
+
+
+async def history_task(app):
+    """Lấy mẫu giá các coin trong history_coins mỗi HISTORY_INTERVAL giây"""
+    backfilled = set()
+    while True:
+        coins = [c for c in load_config().get("history_coins", []) if _COIN_ID_RE.match(c)]
+        for cid in coins:
+            if cid not in backfilled and HISTORY.empty(cid):
+                backfilled.add(cid)
+                try:
+                    await _backfill_history(cid)
+                except Exception as e:
+                    logger.warning("Lỗi nạp lịch sử %s: %s", cid, e)
+        if coins:
+            try:
+                quotes = await get_quotes(coins, priority="low")
+                now = time.time()
+                for cid, q in quotes.items():
+                    if not q.get("stale"):
+                        HISTORY.record(cid, q["usd"], now)
+            except UpstreamBusy as e:
+                logger.warning("Bỏ qua lượt lấy mẫu lịch sử: %s", e)
+            except Exception as e:
+                logger.warning("Lỗi lấy mẫu lịch sử: %s", e)
+        await asyncio.sleep(HISTORY_INTERVAL)
+
+
+def sparkline(values: array, width: int = SPARK_WIDTH) -> str:
+    if len(values) > width:  # gộp theo giá đóng cửa của mỗi đoạn
+        values = [values[min(len(values) - 1, (i + 1) * len(values) // width - 1)] for i in range(width)]
+    lo, hi = min(values), max(values)
+    span = (hi - lo) or 1.0
+    top = len(SPARK_BARS) - 1
+    return "".join(SPARK_BARS[round((v - lo) / span * top)] for v in values)
+
+
+def parse_range(text: str) -> Optional[int]:
+    m = _RANGE_RE.match(text.lower())
+    if not m:
+        return None
+    seconds = int(m.group(1)) * _RANGE_UNITS[m.group(2)]
+    return seconds if 0 < seconds <= HISTORY_TIERS[-1][0] * HISTORY_TIERS[-1][1] else None
+
+
+async def chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_registered(update.effective_user.id):
+        await update.message.reply_text("🔒 Cần /dangky trước.")
+        return
+    if not context.args:
+        await update.message.reply_text("⚙️ Dùng: /chart btc [1h|24h|7d|30d|1y]")
+        return
+    label = context.args[1].lower() if len(context.args) > 1 else CHART_DEFAULT_RANGE
+    seconds = parse_range(label)
+    if seconds is None:
+        await update.message.reply_text("❌ Khoảng thời gian không hợp lệ (vd: 6h, 24h, 7d, 30d, 1y).")
+        return
+    index = await get_coin_index()
+    coin = index.resolve(context.args[0].lower()) if index is not None else None
+    if coin is None:
+        await update.message.reply_text("❌ Không tìm thấy coin.")
+        return
+    ts, px = HISTORY.points(coin.id, seconds) if HISTORY.has(coin.id) else ((), ())
+    if len(px) < 2:
+        watched = ", ".join(load_config().get("history_coins", [])) or "chưa có"
+        await update.message.reply_text(
+            f"⚠️ Chưa có dữ liệu lịch sử cho {coin.name}.\nĐang lưu: {watched}"
+        )
+        return
+    change = (px[-1] / px[0] - 1) * 100 if px[0] else 0.0
+    msg = (
+        f"📈 <b>{pyhtml.escape(coin.name)} ({coin.symbol.upper()})</b> — {label}\n"
+        f"<code>{sparkline(px)}</code>\n"
+        f"Thấp ${min(px):,.6g} · Cao ${max(px):,.6g} · Hiện ${px[-1]:,.6g} ({change:+.2f}%)\n"
+        f"<i>{len(px)} mẫu từ {datetime.fromtimestamp(ts[0]).strftime('%d/%m %H:%M')}</i>"
+    )
+    await update.message.reply_text(msg, parse_mode="HTML")
+
+
+# ===== INLINE MODE =====
+# @girlhonghot <coin> trong mọi chat: chỉ đọc index / cache trong RAM, không gọi
+# upstream trên đường trả lời. Giá thiếu hoặc hết hạn được làm mới nền để phím
+# gõ tiếp theo trúng cache; query bị query mới hơn của cùng user thay thế thì bỏ.
+INLINE_DEBOUNCE = 0.15         # giây chờ xem user có gõ tiếp không
+INLINE_MAX_COINS = 5
+INLINE_MAX_NEWS = 5
+INLINE_CACHE_TIME = QUOTE_TTL  # giây client được dùng lại kết quả
+INLINE_LATEST: Dict[int, str] = {}     # user id -> id inline query mới nhất
+INLINE_PREFETCH: set = set()           # giữ tham chiếu task làm mới giá nền
+
+
+async def _prefetch_quotes(ids: List[str]) -> None:
+    try:
+        await get_quotes(ids, priority="low")
+    except Exception as e:
+        logger.debug("Prefetch giá inline lỗi: %s", e)
+
+
+def _coin_result(c: Coin, now: float) -> Tuple[InlineQueryResultArticle, bool]:
+    """Thẻ giá từ QUOTE_CACHE; cờ thứ hai = cần làm mới giá"""
+    hit = QUOTE_CACHE.get(c.id)
+    label = f"{c.name} ({c.symbol.upper()})"
+    if hit is None:
+        return InlineQueryResultArticle(
+            id=f"coin:{c.id}"[:64], title=label, description="⏳ Đang tải giá, gõ lại sau giây lát",
+            input_message_content=InputTextMessageContent(f"💰 {pyhtml.escape(label)}", parse_mode="HTML"),
+        ), True
+    ts, q = hit
+    fresh = now - ts < QUOTE_TTL
+    quote = q if fresh else dict(q, stale=True)
+    line = f"${q['usd']:,}{format_change(quote)}{history_changes(c.id, q['usd'])}"
+    return InlineQueryResultArticle(
+        id=f"coin:{c.id}"[:64],
+        title=f"{label}: ${q['usd']:,}",
+        description=line,
+        input_message_content=InputTextMessageContent(
+            f"💰 <b>{pyhtml.escape(label)}</b>: {pyhtml.escape(line)}", parse_mode="HTML"
+        ),
+    ), not fresh
+
+
+def _news_filter(words: List[str], coin: Optional[Coin]):
+    """Lọc tiêu đề: theo symbol / tên coin nếu query là một coin, không thì chứa mọi từ"""
+    if coin is not None:
+        name = coin.name.lower()
+        return lambda title: name in title or coin.symbol in _TITLE_TOKEN_RE.findall(title)
+    return lambda title: all(w in title for w in words)
+
+
+def _news_results(match, limit: int) -> List[InlineQueryResultArticle]:
+    feeds = dedupe_feeds({src: st["items"] for src, st in FEED_STORE.items()})
+    results = []
+    for items in feeds.values():
+        for a in items or ():
+            if not match(a.title.lower()):
+                continue
+            results.append(InlineQueryResultArticle(
+                id=f"news:{url_key(a.link):x}",
+                title=a.title,
+                description=urlsplit(a.link).netloc,
+                url=a.link,
+                input_message_content=InputTextMessageContent(
+                    f"📰 <a href=\"{pyhtml.escape(a.link)}\">{pyhtml.escape(a.title)}</a>", parse_mode="HTML"
+                ),
+            ))
+            if len(results) >= limit:
+                return results
+    return results
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    iq = update.inline_query
+    uid = iq.from_user.id
+    if not (is_registered(uid) or is_admin(uid)):
+        await iq.answer([], cache_time=60, is_personal=True,
+                        button=InlineQueryResultsButton("🔒 Cần /dangky trước", start_parameter="dangky"))
+        return
+    INLINE_LATEST[uid] = iq.id
+    await asyncio.sleep(INLINE_DEBOUNCE)
+    if INLINE_LATEST.get(uid) != iq.id:
+        return  # đã có query mới hơn
+    del INLINE_LATEST[uid]
+
+    words = iq.query.lower().split()
+    index = COIN_CACHE["index"]
+    coins = index.complete(words[0] if words else "", INLINE_MAX_COINS) if index is not None else []
+    exact = index.resolve(words[0]) if index is not None and words else None
+    now = time.monotonic()
+    results, refresh = [], []
+    for c in coins:
+        result, stale = _coin_result(c, now)
+        results.append(result)
+        if stale:
+            refresh.append(c.id)
+    results += _news_results(_news_filter(words, exact), INLINE_MAX_NEWS)
+    if refresh:
+        task = asyncio.create_task(_prefetch_quotes(refresh))
+        INLINE_PREFETCH.add(task)
+        task.add_done_callback(INLINE_PREFETCH.discard)
+    await iq.answer(results, cache_time=1 if refresh else INLINE_CACHE_TIME, is_personal=True)
+
+
+# ===== AI CHAT =====
+AI_URL = os.getenv("CHATANYWHERE_API_URL", "https://api.chatanywhere.tech/v1/chat/completions")
+AI_MODEL = "gpt-4o-mini"
+AI_SYSTEM_PROMPT = "Bạn là trợ lý crypto dễ thương, trả lời ngắn gọn và bằng tiếng Việt."
+AI_MAX_CONCURRENCY = 8         # số completion chạy song song toàn bot
+AI_PER_CHAT_CONCURRENCY = 1    # mỗi chat chỉ một completion tại một thời điểm
+AI_EDIT_INTERVAL = 1.0         # giây giữa hai lần edit (chat riêng)
+AI_EDIT_INTERVAL_GROUP = 3.0   # nhóm: Telegram giới hạn ~20 tin/phút
+AI_CURSOR = " ▌"
+TG_MAX_MESSAGE = 4096
+AI_SEMAPHORE = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+AI_CHAT_SLOTS: Dict[int, List[Any]] = {}   # chat_id -> [Semaphore, số người đang dùng]
+
+
+class AIError(Exception):
+    def __init__(self, status: int):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+
+@contextlib.asynccontextmanager
+async def ai_slot(chat_id: int):
+    """Giữ một suất completion: trước là suất của chat, sau là suất toàn cục"""
+    entry = AI_CHAT_SLOTS.get(chat_id)
+    if entry is None:
+        entry = AI_CHAT_SLOTS[chat_id] = [asyncio.Semaphore(AI_PER_CHAT_CONCURRENCY), 0]
+    entry[1] += 1
+    try:
+        async with entry[0], AI_SEMAPHORE:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            AI_CHAT_SLOTS.pop(chat_id, None)
+
+
+def _ai_headers() -> Dict[str, str]:
+    return {
+        "Authorization": f"Bearer {CHATANYWHERE_API_KEY}",
+        "Content-Type": "application/json",
+    }
+
+
+async def stream_completion(prompt: str) -> AsyncIterator[str]:
+    """Gọi chat/completions với stream=True, yield từng đoạn text (SSE)"""
+    async with get_session().post(
+        AI_URL,
+        headers=_ai_headers(),
+        json={
+            "model": AI_MODEL,
+            "messages": [
+                {"role": "system", "content": AI_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt},
+            ],
+            "max_tokens": 500,
+            "stream": True,
+        },
+        timeout=http_timeout("ai_stream"),
+    ) as resp:
+        if resp.status != 200:
+            raise AIError(resp.status)
+        async for raw in resp.content:
+            line = raw.decode("utf-8", "ignore").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                choices = json.loads(data).get("choices") or [{}]
+            except ValueError:
+                continue
+            delta = (choices[0].get("delta") or {}).get("content")
+            if delta:
+                yield delta
+
+
+def _split_point(text: str, limit: int) -> int:
+    """Vị trí cắt đẹp (xuống dòng / khoảng trắng) không vượt quá limit"""
+    for sep in ("\n", " "):
+        cut = text.rfind(sep, limit // 2, limit)
+        if cut > 0:
+            return cut
+    return limit
+
+
+class StreamingReply:
+    """Hiển thị câu trả lời dần dần: gửi tin đầu tiên rồi edit có throttle,
+    sang tin mới khi vượt 4096 ký tự."""
+
+    def __init__(self, msg, interval: float):
+        self.msg = msg
+        self.interval = interval
+        self.current = None      # Message đang được edit
+        self.text = ""
+        self.full = ""           # toàn bộ câu trả lời (để cache)
+        self.shown = ""
+        self.last_edit = 0.0
+
+    async def _show(self, text: str, final: bool = False) -> None:
+        if not text.strip():
+            return
+        body = text if final else text + AI_CURSOR
+        if body == self.shown:
+            return
+        for _ in range(3):
+            try:
+                if self.current is None:
+                    self.current = await self.msg.reply_text(body)
+                else:
+                    await self.current.edit_text(body)
+                break
+            except RetryAfter as e:
+                if not final:
+                    break  # bỏ qua lần edit trung gian, lần sau sẽ cập nhật
+                await asyncio.sleep(_retry_after_seconds(e))
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+                break
+        self.shown = body
+        self.last_edit = time.monotonic()
+
+    async def push(self, delta: str) -> None:
+        self.text += delta
+        self.full += delta
+        while len(self.text) + len(AI_CURSOR) > TG_MAX_MESSAGE:
+            cut = _split_point(self.text, TG_MAX_MESSAGE - len(AI_CURSOR))
+            head, self.text = self.text[:cut], self.text[cut:].lstrip()
+            await self._show(head, final=True)
+            self.current, self.shown = None, ""
+        if self.current is None or time.monotonic() - self.last_edit >= self.interval:
+            await self._show(self.text)
+
+    async def finish(self) -> bool:
+        """Edit lần cuối (bỏ con trỏ); trả về False nếu AI không trả lời gì"""
+        await self._show(self.text, final=True)
+        return self.current is not None
+
+
+# ===== AI RESPONSE CACHE =====
+AI_CACHE_TTL = 6 * 3600        # giây
+AI_CACHE_PRICE_TTL = 60        # giây cho câu hỏi về giá; 0 = không cache
+AI_CACHE_MAX_BYTES = 2 * 1024 * 1024
+AI_CACHE_MAX_ENTRIES = 2000
+AI_CACHE_FUZZY = False         # bật để tra cả câu gần giống (trigram Jaccard + khớp từng từ)
+AI_CACHE_SIMILARITY = 0.8
+AI_CACHE_TYPO_MIN_LEN = 4      # từ ngắn hơn phải khớp y hệt, dài hơn cho phép sai 1 ký tự
+_PRICE_RE = re.compile(r"\b(gia|price|bao nhieu|usd|vnd|hom nay|bay gio|luc nay)\b|\$|\d")
+
+
+def strip_diacritics(text: str) -> str:
+    text = unicodedata.normalize("NFD", text).replace("đ", "d").replace("Đ", "D")
+    return "".join(ch for ch in text if not unicodedata.combining(ch))
+
+
+def normalize_prompt(text: str) -> str:
+    """NFC + casefold + gộp khoảng trắng + bỏ dấu câu cuối"""
+    text = unicodedata.normalize("NFC", text).casefold()
+    return re.sub(r"\s+", " ", text).strip(" ?!.…,")
+
+
+def ai_cache_ttl(key: str) -> float:
+    return AI_CACHE_PRICE_TTL if _PRICE_RE.search(strip_diacritics(key)) else AI_CACHE_TTL
 
-async def addnews(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Không có quyền.")
-        return
-    if not context.args:
-        await update.message.reply_text("⚙️ Dùng: /addnews <url>")
-        return
-    url = context.args[0]
-    cfg = load_config()
-    if url in cfg["news_sources"]:
-        await update.message.reply_text("⚠️ Nguồn đã tồn tại.")
-        return
-    cfg["news_sources"].append(url)
-    save_config(cfg)
-    await update.message.reply_text("✅ Đã thêm nguồn tin.")
 
+def _one_edit(a: str, b: str) -> bool:
+    """a và b cách nhau tối đa 1 thao tác thêm / xóa / thay ký tự"""
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    return a[i + (len(a) == len(b)):] == b[i + 1:]
 
-async def delnews(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(update.effective_user.id):
-        await update.message.reply_text("🚫 Không có quyền.")
-        return
-    if not context.args:
-        await update.message.reply_text("⚙️ Dùng: /delnews <url>")
-        return
-    url = context.args[0]
-    cfg = load_config()
-    if url not in cfg["news_sources"]:
-        await update.message.reply_text("❌ Không có nguồn này.")
-        return
-    cfg["news_sources"].remove(url)
-    save_config(cfg)
-    await update.message.reply_text("🗑️ Đã xóa nguồn tin.")
 
+def same_words(a: str, b: str) -> bool:
+    """Hai câu có cùng tập từ, chỉ khác lỗi gõ nhỏ (mua/bán, có/không... đều bị loại)"""
+    wa, wb = set(strip_diacritics(a).split()), set(strip_diacritics(b).split())
+    only_a, only_b = wa - wb, wb - wa
+    if len(only_a) != len(only_b):
+        return False
+    return all(
+        len(x) >= AI_CACHE_TYPO_MIN_LEN and any(len(y) >= AI_CACHE_TYPO_MIN_LEN and _one_edit(x, y) for y in only_b)
+        for x in only_a
+    )
 
-async def listnews(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    cfg = load_config()
-    msg = "🗞️ *Danh sách nguồn tin:*\n\n"
-    for s in cfg["news_sources"]:
-        msg += f"• {s}\n"
-    await update.message.reply_text(msg, parse_mode="Markdown")
 
+class AIResponseCache:
+    """LRU + TTL cho câu trả lời AI, giới hạn theo byte; có tra cứu gần đúng"""
 
-# ===== PRICE / TOP =====
-async def price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_registered(update.effective_user.id):
-        await update.message.reply_text("🔒 Cần /dangky trước.")
-        return
-    if not context.args:
-        await update.message.reply_text("⚙️ Dùng: /price btc hoặc /price bitcoin")
-        return
-    query = context.args[0].lower()
+    def __init__(self, max_bytes: int, max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[float, str, frozenset]]" = OrderedDict()
+        self.grams: Dict[str, set] = {}   # trigram -> các key chứa nó
+        self.bytes = 0
+        self.hits = self.fuzzy_hits = self.misses = 0
 
-    # update coin cache once per hour
-    now_ts = int(datetime.utcnow().timestamp())
-    if now_ts - COIN_CACHE["last_update"] > 3600 or not COIN_CACHE["data"]:
-        data = await fetch_json("https://api.coingecko.com/api/v3/coins/list")
-        if isinstance(data, list):
-            COIN_CACHE["data"] = [c for c in data if isinstance(c, dict)]
-        else:
-            COIN_CACHE["data"] = []
-        COIN_CACHE["last_update"] = now_ts
+    @staticmethod
+    def _trigrams(key: str) -> frozenset:
+        s = f" {strip_diacritics(key)} "
+        return frozenset(s[i:i + 3] for i in range(len(s) - 2))
 
-    coins = COIN_CACHE["data"]
-    match = None
-    try:
-        match = next((c for c in coins if c.get("id", "").lower() == query), None)
-    except Exception:
-        match = None
-
-    if not match:
-        symbol_matches = [c for c in coins if c.get("symbol", "").lower() == query]
-        if len(symbol_matches) == 1:
-            match = symbol_matches[0]
-        elif len(symbol_matches) > 1:
-            # try search endpoint to pick best candidate
-            s = await fetch_json(f"https://api.coingecko.com/api/v3/search?query={query}")
-            candidates = [c for c in s.get("coins", []) if isinstance(c, dict) and c.get("symbol", "").lower() == query]
-            if candidates:
-                candidates_sorted = sorted(candidates, key=lambda x: x.get("market_cap_rank") or 10**9)
-                chosen_id = candidates_sorted[0]["id"]
-                match = next((c for c in coins if c.get("id") == chosen_id), None)
+    @staticmethod
+    def _size(key: str, answer: str) -> int:
+        return len(key.encode()) + len(answer.encode())
+
+    def _evict(self, key: str) -> None:
+        _, answer, grams = self.entries.pop(key)
+        self.bytes -= self._size(key, answer)
+        for g in grams:
+            keys = self.grams.get(g)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.grams[g]
+
+    def _live(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._evict(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def _nearest(self, key: str) -> Optional[str]:
+        grams = self._trigrams(key)
+        digits = set(re.findall(r"\d+", key))
+        counts: Dict[str, int] = {}
+        for g in grams:
+            for k in self.grams.get(g, ()):
+                counts[k] = counts.get(k, 0) + 1
+        best, best_score = None, AI_CACHE_SIMILARITY
+        for k, shared in counts.items():
+            other = self.entries[k][2]
+            score = shared / (len(grams) + len(other) - shared)
+            if score >= best_score and set(re.findall(r"\d+", k)) == digits and same_words(key, k):
+                best, best_score = k, score
+        return best
+
+    def get(self, key: str) -> Optional[str]:
+        answer = self._live(key)
+        if answer is None and AI_CACHE_FUZZY:
+            near = self._nearest(key)
+            answer = self._live(near) if near else None
+            if answer is not None:
+                self.fuzzy_hits += 1
+        if answer is None:
+            self.misses += 1
         else:
-            match = next((c for c in coins if c.get("name", "").lower() == query), None)
+            self.hits += 1
+        return answer
 
-    if not match:
-        await update.message.reply_text("❌ Không tìm thấy coin.")
-        return
+    def put(self, key: str, answer: str, ttl: float) -> None:
+        size = self._size(key, answer)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._evict(key)
+        grams = self._trigrams(key)
+        self.entries[key] = (time.monotonic() + ttl, answer, grams)
+        for g in grams:
+            self.grams.setdefault(g, set()).add(key)
+        self.bytes += size
+        while self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+            self._evict(next(iter(self.entries)))
 
-    cid = match["id"]
-    res = await fetch_json(f"https://api.coingecko.com/api/v3/simple/price?ids={cid}&vs_currencies=usd")
-    price_val = None
-    if isinstance(res, dict):
-        price_val = res.get(cid, {}).get("usd")
-    if price_val is not None:
-        await update.message.reply_text(
-            f"💰 Giá {match.get('name', cid).title()} ({match.get('symbol','').upper()}): ${price_val:,}"
-        )
-    else:
-        await update.message.reply_text("⚠️ Không lấy được giá coin này.")
 
+AI_CACHE = AIResponseCache(AI_CACHE_MAX_BYTES, AI_CACHE_MAX_ENTRIES)
 
-async def top(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_registered(update.effective_user.id):
-        await update.message.reply_text("🔒 Cần /dangky trước.")
-        return
-    data = await fetch_json("https://api.coingecko.com/api/v3/coins/markets?vs_currency=usd&per_page=10")
-    if not isinstance(data, list):
-        await update.message.reply_text("⚠️ Lỗi dữ liệu từ API.")
-        return
-    msg = "🏆 *Top 10 Coin theo vốn hóa:*\n\n"
-    for i, c in enumerate(data[:10], 1):
-        name = c.get("name", "Unknown")
-        symbol = c.get("symbol", "").upper()
-        price = c.get("current_price")
-        price_str = f"${price:,.2f}" if isinstance(price, (int, float)) else "N/A"
-        msg += f"{i}. {name} ({symbol}): {price_str}\n"
-    await update.message.reply_text(msg, parse_mode="Markdown")
+
+async def reply_long(msg, text: str) -> None:
+    """Gửi text dài thành nhiều tin ≤ 4096 ký tự"""
+    while text:
+        cut = len(text) if len(text) <= TG_MAX_MESSAGE else _split_point(text, TG_MAX_MESSAGE)
+        await msg.reply_text(text[:cut])
+        text = text[cut:].lstrip()
 
 
-# ===== AI CHAT =====
 async def ai_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not msg.text:
         return
 
     # In groups require mention
-    if msg.chat.type in ["group", "supergroup"]:
+    is_group = msg.chat.type in ["group", "supergroup"]
+    if is_group:
         if not msg.entities or not any(e.type == MessageEntity.MENTION and "@girlhonghot" in msg.text for e in msg.entities):
             return
 
     prompt = msg.text.replace("@girlhonghot", "").strip()
     if not prompt:
         return
+    key = normalize_prompt(prompt)
+    ttl = ai_cache_ttl(key)
+    cached = AI_CACHE.get(key) if ttl > 0 else None
+    if cached is not None:
+        await reply_long(msg, cached)
+        return
     if not CHATANYWHERE_API_KEY:
         await msg.reply_text("⚠️ AI chat chưa được cấu hình API key.")
         return
 
     try:
-        await context.bot.send_chat_action(chat_id=msg.chat_id, action=ChatAction.TYPING)
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                "https://api.chatanywhere.tech/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {CHATANYWHERE_API_KEY}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": "gpt-4o-mini",
-                    "messages": [
-                        {"role": "system", "content": "Bạn là trợ lý crypto dễ thương, trả lời ngắn gọn và bằng tiếng Việt."},
-                        {"role": "user", "content": prompt},
-                    ],
-                    "max_tokens": 500,
-                },
-                timeout=30,
-            ) as resp:
-                if resp.status != 200:
-                    await msg.reply_text(f"⚠️ Lỗi AI ({resp.status})")
-                    return
-                data = await resp.json()
-                reply = data["choices"][0]["message"]["content"]
-                await msg.reply_text(reply)
+        async with ai_slot(msg.chat_id):
+            await context.bot.send_chat_action(chat_id=msg.chat_id, action=ChatAction.TYPING)
+            reply = StreamingReply(msg, AI_EDIT_INTERVAL_GROUP if is_group else AI_EDIT_INTERVAL)
+            async for delta in stream_completion(prompt):
+                await reply.push(delta)
+            if not await reply.finish():
+                await msg.reply_text("⚠️ AI không trả lời.")
+                return
+            AI_CACHE.put(key, reply.full.strip(), ttl)
+    except AIError as e:
+        await msg.reply_text(f"⚠️ Lỗi AI ({e.status})")
     except Exception as e:
         await msg.reply_text(f"⚠️ Lỗi khi gọi AI: {e}")
 
 
+# ===== NEWS DIGEST =====
+# Tùy chọn "news_digest": gom các tiêu đề mới của một lượt báo cáo vào MỘT request
+# completion để lấy tóm tắt tiếng Việt. Tóm tắt cache theo URL key nên mỗi bài chỉ
+# tóm tắt một lần; quá hạn chót thì báo cáo dùng tiêu đề gốc, request vẫn chạy nền
+# để lần dựng sau có sẵn.
+DIGEST_CACHE_MAX = 2000
+DIGEST_ITEM_TOKENS = 60        # token trả lời ước tính cho mỗi tóm tắt
+DIGEST_PROMPT = (
+    "Tóm tắt mỗi tiêu đề tin crypto dưới đây thành một câu tiếng Việt ngắn (tối đa 20 từ). "
+    "Trả lời đúng định dạng '<số>. <tóm tắt>' mỗi dòng, giữ nguyên số thứ tự, không thêm gì khác."
+)
+_DIGEST_LINE_RE = re.compile(r"^\s*(\d+)[.)]\s*(.+?)\s*$")
+DIGEST_CACHE: "OrderedDict[int, str]" = OrderedDict()   # url key -> tóm tắt
+DIGEST_INFLIGHT: Dict[int, asyncio.Task] = {}
+
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng thô (~3 ký tự / token cho tiếng Anh + Việt lẫn nhau)"""
+    return len(text) // 3 + 1
+
+
+async def chat_completion(messages: List[Dict[str, str]], max_tokens: int) -> str:
+    """chat/completions không stream, trả về nội dung câu trả lời"""
+    async with AI_SEMAPHORE:
+        async with get_session().post(
+            AI_URL,
+            headers=_ai_headers(),
+            json={"model": AI_MODEL, "messages": messages, "max_tokens": max_tokens},
+            timeout=http_timeout("ai"),
+        ) as resp:
+            if resp.status != 200:
+                raise AIError(resp.status)
+            data = await resp.json(content_type=None)
+    return data["choices"][0]["message"]["content"]
+
+
+async def _summarize_batch(batch: List[Tuple[int, Article]]) -> None:
+    listing = "\n".join(f"{i}. {a.title}" for i, (_, a) in enumerate(batch, 1))
+    try:
+        text = await chat_completion(
+            [{"role": "system", "content": DIGEST_PROMPT}, {"role": "user", "content": listing}],
+            DIGEST_ITEM_TOKENS * len(batch),
+        )
+    except Exception as e:
+        logger.warning("Lỗi tóm tắt tin: %s", e)
+        METRICS.inc("bot_digest_requests_total", (("result", "error"),))
+        return
+    METRICS.inc("bot_digest_requests_total", (("result", "ok"),))
+    for line in text.splitlines():
+        m = _DIGEST_LINE_RE.match(line)
+        if m and 1 <= int(m.group(1)) <= len(batch):
+            DIGEST_CACHE[batch[int(m.group(1)) - 1][0]] = m.group(2)
+    while len(DIGEST_CACHE) > DIGEST_CACHE_MAX:
+        DIGEST_CACHE.popitem(last=False)
+
+
+async def summarize_headlines(articles: List[Article], cfg: Dict[str, Any]) -> Dict[int, str]:
+    """url key -> tóm tắt cho các bài lấy được trong hạn chót `news_digest_deadline`.
+
+    Bài chưa có trong cache được gửi chung một request, trong giới hạn
+    `news_digest_tokens` (prompt + trả lời); phần vượt ngân sách giữ tiêu đề gốc.
+    """
+    keys = [(url_key(a.link), a) for a in articles]
+    budget = int(cfg.get("news_digest_tokens", 1500)) - estimate_tokens(DIGEST_PROMPT)
+    batch, waits = [], set()
+    for key, a in keys:
+        if key in DIGEST_CACHE:
+            DIGEST_CACHE.move_to_end(key)
+            cache_hit("digest", "hit")
+        elif key in DIGEST_INFLIGHT:
+            waits.add(DIGEST_INFLIGHT[key])
+            cache_hit("digest", "coalesced")
+        else:
+            cost = estimate_tokens(a.title) + DIGEST_ITEM_TOKENS
+            if cost > budget:
+                continue
+            budget -= cost
+            batch.append((key, a))
+            cache_hit("digest", "miss")
+    if batch and CHATANYWHERE_API_KEY:
+        task = asyncio.create_task(_summarize_batch(batch))
+        for key, _ in batch:
+            DIGEST_INFLIGHT[key] = task
+
+        def _done(t: asyncio.Task, batch_keys: Tuple[int, ...] = tuple(k for k, _ in batch)) -> None:
+            for k in batch_keys:
+                if DIGEST_INFLIGHT.get(k) is t:
+                    del DIGEST_INFLIGHT[k]
+
+        task.add_done_callback(_done)
+        waits.add(task)
+    if waits:
+        _, pending = await asyncio.wait(waits, timeout=float(cfg.get("news_digest_deadline", 8)))
+        if pending:
+            logger.warning("Tóm tắt tin quá hạn chót, dùng tiêu đề gốc.")
+            METRICS.inc("bot_digest_requests_total", (("result", "deadline"),))
+    return {key: DIGEST_CACHE[key] for key, _ in keys if key in DIGEST_CACHE}
+
+
 # ===== REPORTS =====
-async def generate_report() -> str:
+async def generate_report() -> Dict[str, Any]:
+    """Các phần của báo cáo: tổng quan thị trường, tin các nguồn (chưa lọc), snapshot coin.
+
+    Phần tin được ghép riêng cho từng khung giờ bằng render_report().
+    """
     cfg = load_config()
     # Market overview
-    global_data = await fetch_json("https://api.coingecko.com/api/v3/global")
-    data = global_data.get("data", {})
-    total_mcap = data.get("total_market_cap", {}).get("usd", 0)
-    total_volume = data.get("total_volume", {}).get("usd", 0)
-    btc_dom = data.get("market_cap_percentage", {}).get("btc", 0)
-
     msg = "📊 <b>BÁO CÁO TỔNG HỢP CRYPTO</b>\n\n"
     msg += "🌍 <b>TỔNG QUAN THỊ TRƯỜNG</b>\n"
-    msg += f"• Tổng vốn hóa: ${total_mcap:,.0f}\n"
-    msg += f"• Khối lượng 24h: ${total_volume:,.0f}\n"
-    msg += f"• BTC Dominance: {btc_dom:.2f}%\n\n"
-
-    # News highlights
-    msg += "📰 <b>TIN TỨC NỔI BẬT</b>\n"
-    for src in cfg.get("news_sources", []):
-        items = await fetch_items_from_feed(src)
-        if not items:
-            msg += f"⚠️ Không có bài viết từ {src}\n\n"
-            continue
-        for i in items[:3]:
-            title = pyhtml.escape(
-                getattr(i, "title", "").text.strip() if getattr(i, "title", None) else "Không có tiêu đề"
-            )
-            link = None
-            if i.find("link") and getattr(i.find("link"), "text", "").strip().startswith("http"):
-                link = i.find("link").text.strip()
-            elif i.find("guid") and "http" in getattr(i.find("guid"), "text", ""):
-                link = i.find("guid").text.strip()
-            else:
-                link = src
-            msg += f"• <a href=\"{link}\">{title}</a>\n"
+    try:
+        global_resp = await COINGECKO.get("/global")
+        data = global_resp.data.get("data") or {}
+        total_mcap = data["total_market_cap"]["usd"]
+        total_volume = data["total_volume"]["usd"]
+        btc_dom = data["market_cap_percentage"]["btc"]
+        msg += f"• Tổng vốn hóa: ${total_mcap:,.0f}\n"
+        msg += f"• Khối lượng 24h: ${total_volume:,.0f}\n"
+        msg += f"• BTC Dominance: {btc_dom:.2f}%\n"
+        if global_resp.stale:
+            msg += "⚠️ <i>CoinGecko đang bận, số liệu từ lần cập nhật trước.</i>\n"
         msg += "\n"
+    except (UpstreamBusy, KeyError, TypeError, AttributeError):
+        msg += "⚠️ Không lấy được dữ liệu thị trường (CoinGecko bận).\n\n"
+
+    # News highlights: lọc theo từng khung giờ trong render_report()
+    feeds = await get_news(cfg)
 
     # Snapshot (few coins)
+    head, msg = msg, ""
     try:
-        coins = ["bitcoin", "ethereum", "bnb", "solana", "xrp"]
-        coin_icons = {"bitcoin": "🟠", "ethereum": "💎", "bnb": "🟡", "solana": "🟣", "xrp": "💠"}
-        data_coins = await fetch_json(
-            "https://api.coingecko.com/api/v3/coins/markets?vs_currency=usd&ids=" + ",".join(coins)
-        )
-        for c in data_coins:
-            icon = coin_icons.get(c.get("id", ""), "💰")
-            msg += f"{icon} <b>{c.get('name')}</b>: ${c.get('current_price'):,} ({c.get('price_change_percentage_24h', 0):+.2f}%)\n"
+        coin_icons = {"bitcoin": "🟠", "ethereum": "💎", "binancecoin": "🟡", "solana": "🟣", "ripple": "💠"}
+        quotes = await get_quotes(list(coin_icons))
+        index = COIN_CACHE["index"]
+        for cid, icon in coin_icons.items():
+            if cid not in quotes:
+                continue
+            coin = index.by_id.get(cid) if index is not None else None
+            name = coin.name if coin else cid.title()
+            msg += f"{icon} <b>{name}</b>: ${quotes[cid]['usd']:,}{format_change(quotes[cid])}{history_changes(cid, quotes[cid]['usd'])}\n"
     except Exception:
         msg += "⚠️ Không thể lấy snapshot coin.\n"
 
-    return msg
+    return {"head": head, "feeds": feeds, "tail": msg}
+
+
+async def render_report(parts: Dict[str, Any], seen: Optional[DedupIndex] = None) -> Tuple[str, List[Article]]:
+    """Ghép báo cáo từ generate_report(); có `seen` thì bỏ các bài đã gửi.
+
+    Trả về (nội dung, các bài đã đưa vào).
+    """
+    cfg = load_config()
+    msg = parts["head"] + "📰 <b>TIN TỨC NỔI BẬT</b>\n"
+    feeds = dedupe_feeds(parts["feeds"], seen)
+    headlines = [a for items in feeds.values() if items for a in items[:3]]
+    summaries = await summarize_headlines(headlines, cfg) if cfg.get("news_digest") else None
+    for src, items in feeds.items():
+        if items is None:
+            msg += f"⏱️ Quá thời gian chờ: {src}\n\n"
+            continue
+        if not items:
+            msg += f"⚠️ Không có bài viết từ {src}\n\n"
+            continue
+        msg += render_feed_items(items, 3, summaries)
+        msg += "\n"
+    if not headlines:
+        msg += "📭 Không có tin mới kể từ báo cáo trước.\n\n" if seen is not None else "📭 Chưa có tin nào.\n\n"
+    return msg + parts["tail"], headlines
+
+
+REPORT_CACHE: Dict[str, Any] = {"parts": None, "text": None, "built": 0.0, "task": None}
+
+
+async def _rebuild_report() -> None:
+    parts = await generate_report()
+    text, _ = await render_report(parts)
+    REPORT_CACHE["parts"], REPORT_CACHE["text"], REPORT_CACHE["built"] = parts, text, time.time()
+    await share_cache("report")
+
+
+def _dump_report() -> Optional[Dict[str, Any]]:
+    if REPORT_CACHE["text"] is None:
+        return None
+    parts = REPORT_CACHE["parts"]
+    feeds = {src: None if items is None else [list(a) for a in items] for src, items in parts["feeds"].items()}
+    return {"parts": {**parts, "feeds": feeds}, "text": REPORT_CACHE["text"], "built": REPORT_CACHE["built"]}
+
+
+async def _load_report(obj: Dict[str, Any]) -> None:
+    if obj["built"] > REPORT_CACHE["built"]:
+        parts = obj["parts"]
+        feeds = {src: None if items is None else [Article(*a) for a in items] for src, items in parts["feeds"].items()}
+        REPORT_CACHE["parts"] = {**parts, "feeds": feeds}
+        REPORT_CACHE["text"], REPORT_CACHE["built"] = obj["text"], obj["built"]
+
+
+warm_cache("report", _dump_report, _load_report)
+
+
+def _report_rebuild() -> asyncio.Task:
+    """Single-flight: mọi yêu cầu đồng thời dùng chung một lần dựng báo cáo"""
+    task = REPORT_CACHE["task"]
+    if task is None or task.done():
+        task = REPORT_CACHE["task"] = asyncio.create_task(_rebuild_report())
+    return task
+
+
+async def get_report(max_age: Optional[float] = None) -> Tuple[str, float]:
+    """Báo cáo từ cache kèm tuổi (giây).
+
+    Cũ hơn `report_max_age` nhưng chưa quá `report_stale_max`: trả ngay bản cũ và
+    dựng lại nền; quá hơn nữa (hoặc chưa có) thì chờ lần dựng chung.
+    """
+    cfg = load_config()
+    if max_age is None:
+        max_age = float(cfg.get("report_max_age", 300))
+    age = time.time() - REPORT_CACHE["built"]
+    if REPORT_CACHE["text"] is None or age > max(max_age, float(cfg.get("report_stale_max", 3600))):
+        cache_hit("report", "miss")
+        await asyncio.shield(_report_rebuild())
+    elif age > max_age:
+        cache_hit("report", "stale")
+        _report_rebuild()
+    else:
+        cache_hit("report", "hit")
+    return REPORT_CACHE["text"], time.time() - REPORT_CACHE["built"]
+
+
+async def fresh_report_parts(max_age: float) -> Dict[str, Any]:
+    """Phần báo cáo cho lượt gửi theo lịch: cũ hơn `max_age` thì luôn chờ dựng lại.
+
+    Khác get_report(): không dùng bản cũ trong cửa sổ `report_stale_max`.
+    """
+    if REPORT_CACHE["parts"] is None or time.time() - REPORT_CACHE["built"] > max_age:
+        cache_hit("report", "miss")
+        await asyncio.shield(_report_rebuild())
+    else:
+        cache_hit("report", "hit")
+    return REPORT_CACHE["parts"]
+
+
+def format_age(seconds: float) -> str:
+    if seconds < 60:
+        return "vừa xong"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} phút trước"
+    return f"{int(seconds // 3600)} giờ trước"
 
 
 async def report_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not (is_admin(update.effective_user.id) or is_registered(update.effective_user.id)):
         await update.message.reply_text("🔒 Cần /dangky trước.")
         return
-    msg = await generate_report()
+    msg, age = await get_report()
+    msg += f"\n🕒 <i>Dữ liệu cập nhật {format_age(age)}</i>"
     await update.message.reply_text(msg, parse_mode="HTML", disable_web_page_preview=True)
 
 
-# ===== SCHEDULED DAILY REPORT TASK =====
-async def send_daily_report_task(app):
-    # Wait until bot is started
-    await app.wait_until_ready()  # ensures application.bot exists and ready (PTB helper)
-    logger.info("Daily report task started.")
-    while True:
-        cfg = load_config()
+# ===== BROADCAST =====
+# Gửi một tin tới nhiều chat qua worker pool, giới hạn bằng token bucket toàn cục
+# + khoảng cách tối thiểu mỗi chat. Tiến độ được checkpoint (COORD.save_state) để resume.
+BROADCAST_RATE = 25            # tin/giây toàn cục (Telegram giới hạn ~30/s)
+BROADCAST_BURST = 5
+BROADCAST_CHAT_INTERVAL = 1.0  # giây giữa hai tin tới cùng một chat
+BROADCAST_WORKERS = 16
+BROADCAST_RETRIES = 3
+BROADCAST_CHECKPOINT_EVERY = 2.0   # giây
+BROADCAST_STATE_FILE = "broadcast_state.json"
+BROADCAST_RESUME_MAX = 6 * 3600    # giây; checkpoint cũ hơn thì bỏ, không gửi báo cáo đã lỗi thời
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+
+class Broadcast:
+    """Một lượt broadcast; trạng thái (pending, thống kê) lưu qua COORD.save_state("broadcast")"""
+
+    def __init__(self, bot, text: str, recipients: List[str], state: Optional[Dict[str, Any]] = None):
+        self.bot = bot
+        self.text = text
+        self.state = state or {
+            "id": datetime.now().strftime("%Y%m%d-%H%M%S"),
+            "text": text,
+            "pending": list(dict.fromkeys(str(r) for r in recipients)),
+            "sent": 0,
+            "failed": 0,
+            "unsubscribed": 0,
+            "elapsed": 0.0,
+        }
+        self.pending = set(self.state["pending"])
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+        self.chat_next: Dict[str, float] = {}
+
+    @classmethod
+    async def resume(cls, bot) -> Optional["Broadcast"]:
         try:
-            h, m = map(int, cfg.get("report_time", "08:00").split(":"))
-        except Exception:
-            h, m = 8, 0
-        now = datetime.now()
-        report_dt = datetime.combine(now.date(), dt_time(hour=h, minute=m))
-        if now >= report_dt:
-            report_dt += timedelta(days=1)
-        wait_seconds = (report_dt - now).total_seconds()
-        logger.info("Next report in %.0f seconds (at %s)", wait_seconds, report_dt.isoformat())
-        await asyncio.sleep(wait_seconds)
-
-        msg = await generate_report()
-
-        # send to group if configured
-        if GROUP_ID:
+            state = await COORD.load_state("broadcast", BROADCAST_STATE_FILE)
+        except Exception as e:
+            logger.warning("Checkpoint broadcast hỏng, bỏ qua: %s", e)
+            return None
+        if state is None:
+            return None
+        age = time.time() - state.get("saved", 0)
+        if age > BROADCAST_RESUME_MAX:
+            logger.warning("Bỏ broadcast %s dở dang (checkpoint cũ %.0f phút).", state.get("id"), age / 60)
+            await COORD.save_state("broadcast", BROADCAST_STATE_FILE, None)
+            return None
+        return cls(bot, state["text"], [], state)
+
+    async def checkpoint(self) -> None:
+        self.state["pending"] = [r for r in self.state["pending"] if r in self.pending]
+        self.state["saved"] = time.time()
+        try:
+            await COORD.save_state("broadcast", BROADCAST_STATE_FILE, self.state)
+        except Exception as e:  # mất một checkpoint không đáng dừng cả lượt gửi
+            logger.warning("Lỗi lưu checkpoint broadcast: %s", e)
+
+    async def _send_one(self, chat_id: str) -> None:
+        for attempt in range(BROADCAST_RETRIES + 1):
+            wait = self.chat_next.get(chat_id, 0.0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self.bucket.acquire()
+            self.chat_next[chat_id] = time.monotonic() + BROADCAST_CHAT_INTERVAL
             try:
-                await app.bot.send_message(int(GROUP_ID), msg, parse_mode="HTML", disable_web_page_preview=True)
-            except Exception as e:
-                logger.warning("Lỗi gửi báo cáo vào nhóm: %s", e)
+                await self.bot.send_message(int(chat_id), self.text, parse_mode="HTML", disable_web_page_preview=True)
+                self.state["sent"] += 1
+                return
+            except RetryAfter as e:
+                self.bucket.pause(_retry_after_seconds(e))
+            except Forbidden as e:
+                logger.info("Chat %s chặn bot (%s), hủy đăng ký.", chat_id, e)
+                if await USERS.remove(chat_id):
+                    self.state["unsubscribed"] += 1
+                self.state["failed"] += 1
+                return
+            except BadRequest as e:
+                logger.warning("Lỗi gửi báo cáo cho %s: %s", chat_id, e)
+                break
+            except NetworkError as e:
+                logger.warning("Lỗi mạng khi gửi cho %s (lần %d): %s", chat_id, attempt + 1, e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+        self.state["failed"] += 1
 
-        # send to users
-        for uid in list(load_config().get("users", {}).keys()):
+    async def _worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            chat_id = await queue.get()
             try:
-                await app.bot.send_message(int(uid), msg, parse_mode="HTML", disable_web_page_preview=True)
+                await self._send_one(chat_id)
             except Exception as e:
-                logger.warning("Lỗi gửi báo cáo cho %s: %s", uid, e)
+                logger.warning("Lỗi gửi báo cáo cho %s: %s", chat_id, e)
+                self.state["failed"] += 1
+            finally:
+                self.pending.discard(chat_id)
+                queue.task_done()
+
+    async def run(self) -> Dict[str, Any]:
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in self.state["pending"]:
+            queue.put_nowait(chat_id)
+        await self.checkpoint()
+        started = time.monotonic()
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(BROADCAST_WORKERS)]
+        joiner = asyncio.create_task(queue.join())
+        try:
+            while not joiner.done():
+                await asyncio.wait([joiner], timeout=BROADCAST_CHECKPOINT_EVERY)
+                self.state["elapsed"] += time.monotonic() - started
+                started = time.monotonic()
+                await self.checkpoint()
+        finally:
+            for w in workers:
+                w.cancel()
+            if not joiner.done():  # bị dừng giữa chừng: lưu tiến độ mới nhất
+                joiner.cancel()
+                self.state["elapsed"] += time.monotonic() - started
+                await self.checkpoint()
+        await COORD.save_state("broadcast", BROADCAST_STATE_FILE, None)
+        return self.state
+
+
+LAST_BROADCAST: Dict[str, Any] = {}
+
+
+async def broadcast_report(app, msg: Optional[str] = None, recipients: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Gửi báo cáo tới `recipients` (mặc định GROUP_ID + mọi user) hoặc tiếp tục lượt bị gián đoạn.
+
+    Thống kê được báo cho admin.
+    """
+    if msg is None:
+        bc = await Broadcast.resume(app.bot)
+        if bc is None:
+            return {}
+        logger.info("Tiếp tục broadcast %s: còn %d chat.", bc.state["id"], len(bc.pending))
+    else:
+        if recipients is None:
+            recipients = ([GROUP_ID] if GROUP_ID else []) + USERS.ids()
+        bc = Broadcast(app.bot, msg, recipients)
+    stats = await bc.run()
+    if stats["unsubscribed"]:
+        await SCHEDULER.reload()
+    elapsed = max(stats["elapsed"], 1e-6)
+    for key in ("sent", "failed", "unsubscribed"):
+        METRICS.inc("bot_broadcast_messages_total", (("result", key),), stats[key])
+    METRICS.set("bot_broadcast_last_throughput", (), stats["sent"] / elapsed)
+    METRICS.set("bot_broadcast_last_duration_seconds", (), elapsed)
+    LAST_BROADCAST.update(stats)
+    summary = (
+        f"📬 Broadcast {stats['id']}: gửi {stats['sent']}, lỗi {stats['failed']}, "
+        f"hủy đăng ký {stats['unsubscribed']} — {elapsed:.1f}s ({stats['sent'] / elapsed:.1f} tin/s)"
+    )
+    logger.info(summary)
+    if ADMIN_ID:
+        try:
+            await app.bot.send_message(int(ADMIN_ID), summary)
+        except Exception as e:
+            logger.warning("Lỗi gửi thống kê broadcast cho admin: %s", e)
+    return stats
+
+
+# ===== SCHEDULER =====
+# Mỗi khung giờ báo cáo (múi giờ + HH:MM) là một job trong heap theo thời điểm
+# chạy kế tiếp; thời điểm các lượt được lưu qua COORD.save_state("schedule") để
+# sau restart / đổi leader vẫn chạy bù lượt bị lỡ. Các job đến hạn cùng lúc gộp người nhận, báo cáo chỉ dựng một lần.
+SCHEDULE_STATE_FILE = "schedule_state.json"
+SCHEDULE_CATCHUP = 6 * 3600    # giây, lượt lỡ lâu hơn thì bỏ qua thay vì gửi muộn
+SCHEDULE_MAX_SLOTS = 6         # số khung giờ tối đa mỗi ngày
+SCHEDULE_RECHECK = 30          # giây; nhiều replica: leader tự phát hiện lịch đổi ở replica khác
+_SLOT_RE = re.compile(r"^([01]?\d|2[0-3]):([0-5]\d)$")
+
+
+def parse_slots(value: Any) -> List[str]:
+    """'07:00,19:30' hoặc ['7:00', '19:30'] -> ['07:00', '19:30'] (bỏ giá trị sai)"""
+    items = value.replace(",", " ").split() if isinstance(value, str) else list(value or [])
+    slots = set()
+    for item in items:
+        m = _SLOT_RE.match(str(item).strip())
+        if m:
+            slots.add(f"{int(m.group(1)):02d}:{m.group(2)}")
+    return sorted(slots)
+
+
+def get_zone(name: Optional[str]) -> Optional[ZoneInfo]:
+    """ZoneInfo theo tên; None = giờ hệ thống. Raise ValueError nếu tên không hợp lệ"""
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError) as e:
+        raise ValueError(f"Múi giờ không hợp lệ: {name}") from e
+
+
+def next_occurrence(slot: str, tz: Optional[str], after: float) -> float:
+    """Epoch của lần tới (sau `after`) đồng hồ ở múi `tz` chỉ `slot`"""
+    zone = get_zone(tz)
+    hh, mm = map(int, slot.split(":"))
+    day = datetime.fromtimestamp(after, zone).date()
+    while True:
+        at = datetime.combine(day, dt_time(hh, mm), zone)
+        ts = at.timestamp() if zone else time.mktime(at.timetuple())
+        if ts > after:
+            return ts
+        day += timedelta(days=1)
+
+
+class Scheduler:
+    """Heap (thời điểm, khung giờ) của các lượt báo cáo; khung giờ = 'tz|HH:MM'"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.heap: List[Tuple[float, str]] = []
+        self.due: Dict[str, float] = {}
+        self.slots: set = set()
+        self.wake = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.loaded = False
+
+    async def _load(self) -> None:
+        self.loaded = True
+        try:
+            state = await COORD.load_state("schedule", self.path) or {}
+            self.due = {k: float(v) for k, v in state.get("jobs", {}).items()}
+        except Exception as e:
+            logger.warning("Lịch báo cáo đã lưu hỏng, tạo lại: %s", e)
+
+    async def _save(self) -> None:
+        try:
+            await COORD.save_state("schedule", self.path, {"jobs": self.due})
+        except Exception as e:
+            logger.warning("Lỗi lưu lịch báo cáo: %s", e)
+
+    @staticmethod
+    def chat_schedule(cfg: Dict[str, Any], chat_id: Any) -> Tuple[List[str], str]:
+        """(khung giờ, múi giờ) áp dụng cho một chat — riêng nếu đã đặt, không thì mặc định"""
+        default_tz = cfg.get("timezone") or ""
+        own = cfg.get("schedules", {}).get(str(chat_id))
+        if own is None:
+            return parse_slots(cfg.get("report_time", "08:00")), default_tz
+        return parse_slots(own.get("times", [])), own.get("tz") or default_tz
+
+    def recipients(self) -> Dict[str, List[str]]:
+        """khung giờ -> danh sách chat nhận báo cáo ở khung đó"""
+        cfg = load_config()
+        out: Dict[str, List[str]] = {}
+        for chat_id in ([GROUP_ID] if GROUP_ID else []) + USERS.ids():
+            times, tz = self.chat_schedule(cfg, chat_id)
+            for slot in times:
+                out.setdefault(f"{tz}|{slot}", []).append(str(chat_id))
+        return out
+
+    async def reload(self) -> None:
+        """Dựng lại heap từ config; khung giờ cũ giữ nguyên lần chạy đã lên lịch"""
+        if not COORD.is_leader:  # chỉ leader giữ lịch, nó sẽ tự thấy config đổi
+            return
+        async with self.lock:
+            if not self.loaded:
+                await self._load()
+            now = time.time()
+            due = {}
+            self.slots = set(self.recipients())
+            for key in self.slots:
+                tz, slot = key.split("|")
+                try:
+                    due[key] = self.due.get(key) or next_occurrence(slot, tz, now)
+                except ValueError as e:
+                    logger.warning("Bỏ khung giờ %s: %s", key, e)
+            self.due = due
+            self.heap = [(ts, key) for key, ts in due.items()]
+            heapq.heapify(self.heap)
+            await self._save()
+        self.wake.set()
+
+    def next_run(self) -> Optional[float]:
+        return self.heap[0][0] if self.heap else None
+
+    async def _sleep_until(self, ts: float) -> bool:
+        """Ngủ tới `ts`; False nếu bị đánh thức sớm vì lịch thay đổi"""
+        self.wake.clear()
+        while True:
+            delay = ts - time.time()
+            if delay <= 0:
+                return True
+            try:
+                await asyncio.wait_for(self.wake.wait(), min(delay, SCHEDULE_RECHECK) if COORD.path else delay)
+                return False
+            except asyncio.TimeoutError:
+                if COORD.path and set(self.recipients()) != self.slots:
+                    await self.reload()
+                    return False
+
+    async def run(self, app) -> None:
+        try:
+            await broadcast_report(app)  # lượt broadcast dở dang trước khi restart
+        except Exception as e:
+            logger.error(f"⚠️ Lỗi tiếp tục broadcast: {e}")
+        self.loaded = False   # có thể vừa nhận quyền leader: đọc lịch leader cũ đã lưu
+        await self.reload()
+        prewarmed = 0.0
+        while True:
+            ts = self.next_run()
+            if ts is None:
+                await self._sleep_until(float("inf"))
+                continue
+            prewarm = float(load_config().get("report_prewarm", 5)) * 60
+            if prewarmed != ts and ts - prewarm > time.time():
+                if not await self._sleep_until(ts - prewarm):
+                    continue
+                prewarmed = ts
+                try:
+                    await _report_rebuild()
+                except Exception as e:
+                    logger.warning("Lỗi dựng sẵn báo cáo: %s", e)
+                continue
+            if not await self._sleep_until(ts):
+                continue
+            await self._fire(app, prewarm)
+
+    async def _fire(self, app, prewarm: float) -> None:
+        async with self.lock:
+            now = time.time()
+            slots = []
+            while self.heap and self.heap[0][0] <= now:
+                ts, key = heapq.heappop(self.heap)
+                tz, slot = key.split("|")
+                self.due[key] = next_occurrence(slot, tz, now)
+                heapq.heappush(self.heap, (self.due[key], key))
+                if now - ts > SCHEDULE_CATCHUP:
+                    logger.warning("Bỏ lượt báo cáo %s lúc %s (lỡ quá lâu).", key, datetime.fromtimestamp(ts).isoformat())
+                else:
+                    slots.append(key)
+            await self._save()
+        if not slots:
+            return
+        by_slot = self.recipients()
+        try:
+            parts = await fresh_report_parts(prewarm + 60)
+            # mỗi khung lọc theo tin nó đã gửi; khung ra cùng nội dung thì gửi chung một lượt
+            batches: Dict[str, Tuple[List[str], List[Tuple[str, List[Article]]]]] = {}
+            done = set()
+            for key in slots:
+                chats = [r for r in by_slot.get(key, []) if r not in done]
+                if not chats:  # không ai nhận: không gửi, không đánh dấu tin đã gửi
+                    continue
+                done.update(chats)
+                msg, articles = await render_report(parts, NEWS_SEEN.get(key))
+                batch = batches.setdefault(msg, ([], []))
+                batch[0].extend(chats)
+                batch[1].append((key, articles))
+            for msg, (recipients, marks) in batches.items():
+                logger.info("Gửi báo cáo khung %s tới %d chat.", ", ".join(k for k, _ in marks), len(recipients))
+                await broadcast_report(app, msg, recipients)
+                for key, articles in marks:
+                    await NEWS_SEEN.mark(key, articles, self.slots)
+        except Exception as e:
+            logger.error(f"⚠️ Lỗi gửi báo cáo: {e}")
+
+
+SCHEDULER = Scheduler(SCHEDULE_STATE_FILE)
+
+
+def _parse_schedule_args(args: List[str]) -> Tuple[List[str], Optional[str]]:
+    """['7:00', '19:00', 'Asia/Ho_Chi_Minh'] -> (['07:00', '19:00'], 'Asia/Ho_Chi_Minh')"""
+    times = [a for a in args if _SLOT_RE.match(a)]
+    rest = [a for a in args if a not in times]
+    if not times or len(rest) > 1:
+        raise ValueError("Định dạng không hợp lệ. Dùng HH:MM (24h).")
+    if len(times) > SCHEDULE_MAX_SLOTS:
+        raise ValueError(f"Tối đa {SCHEDULE_MAX_SLOTS} khung giờ mỗi ngày.")
+    tz = rest[0] if rest else None
+    get_zone(tz)
+    return parse_slots(times), tz
+
+
+def _describe_next(chat_id: Any) -> str:
+    times, tz = Scheduler.chat_schedule(load_config(), chat_id)
+    if not times:
+        return "không nhận báo cáo"
+    ts = min(SCHEDULER.due.get(f"{tz}|{s}") or next_occurrence(s, tz, time.time()) for s in times)
+    when = datetime.fromtimestamp(ts, get_zone(tz)).strftime("%H:%M %d/%m")
+    return f"{', '.join(times)} ({tz or 'giờ máy chủ'}) — lượt tới {when}"
 
 
 # ===== SETTIME =====
@@ -498,22 +3775,159 @@ async def settime(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🚫 Chỉ admin có thể thay đổi giờ báo cáo.")
         return
     if not context.args:
-        await update.message.reply_text("⚙️ Dùng: /settime HH:MM (vd: /settime 09:30)")
+        await update.message.reply_text("⚙️ Dùng: /settime HH:MM [HH:MM ...] [múi giờ] (vd: /settime 07:00 19:00 Asia/Ho_Chi_Minh)")
         return
-    new_time = context.args[0]
     try:
-        hh, mm = new_time.split(":")
-        hh_i = int(hh)
-        mm_i = int(mm)
-        if not (0 <= hh_i < 24 and 0 <= mm_i < 60):
-            raise ValueError
-    except Exception:
-        await update.message.reply_text("❌ Định dạng không hợp lệ. Dùng HH:MM (24h).")
+        times, tz = _parse_schedule_args(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
         return
-    cfg = load_config()
-    cfg["report_time"] = new_time
-    save_config(cfg)
-    await update.message.reply_text(f"⏰ Đã cập nhật giờ báo cáo thành {new_time}")
+    async with CONFIG.edit() as cfg:
+        cfg["report_time"] = times[0] if len(times) == 1 else times
+        if tz:
+            cfg["timezone"] = tz
+    await SCHEDULER.reload()
+    await update.message.reply_text(f"⏰ Đã cập nhật giờ báo cáo mặc định: {_describe_next(None)}")
+
+
+async def mytime(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Giờ nhận báo cáo riêng của chat hiện tại (nhóm: chỉ admin đổi được)"""
+    user, chat = update.effective_user, update.effective_chat
+    if not (is_registered(user.id) or is_admin(user.id)):
+        await update.message.reply_text("🔒 Cần /dangky trước.")
+        return
+    if not context.args:
+        await update.message.reply_text(
+            f"🕒 Lịch báo cáo: {_describe_next(chat.id)}\n"
+            "⚙️ Đổi: /mytime HH:MM [HH:MM ...] [múi giờ] · /mytime off · /mytime default"
+        )
+        return
+    if chat.id != user.id and not is_admin(user.id):
+        await update.message.reply_text("🚫 Chỉ admin đổi được lịch của nhóm.")
+        return
+    arg = context.args[0].lower()
+    if arg == "default":
+        own = None
+    elif arg == "off":
+        own = {"times": []}
+    else:
+        try:
+            times, tz = _parse_schedule_args(context.args)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}")
+            return
+        own = {"times": times, "tz": tz} if tz else {"times": times}
+    async with CONFIG.edit() as cfg:
+        schedules = cfg.setdefault("schedules", {})
+        if own is None:
+            schedules.pop(str(chat.id), None)
+        else:
+            schedules[str(chat.id)] = own
+    await SCHEDULER.reload()
+    await update.message.reply_text(f"✅ Lịch báo cáo: {_describe_next(chat.id)}")
+
+
+# ===== STATS / METRICS ENDPOINT =====
+def _collect_runtime(m: Metrics) -> None:
+    for key, value in COINGECKO.stats.items():
+        m.counters.setdefault("bot_coingecko_requests_total", {})[(("kind", key),)] = value
+    m.set("bot_coingecko_circuit_open", (), 1 if COINGECKO.is_open else 0)
+    for result, value in (("hit", AI_CACHE.hits - AI_CACHE.fuzzy_hits), ("fuzzy_hit", AI_CACHE.fuzzy_hits), ("miss", AI_CACHE.misses)):
+        m.counters.setdefault("bot_cache_requests_total", {})[(("cache", "ai"), ("result", result))] = value
+    m.set("bot_ai_cache_bytes", (), AI_CACHE.bytes)
+    index = COIN_CACHE["index"]
+    m.set("bot_coin_index_size", (), len(index) if index is not None else 0)
+    m.set("bot_coin_index_last_update_timestamp", (), COIN_CACHE["last_update"])
+    m.set("bot_feed_store_articles", (), sum(len(st["items"] or []) for st in FEED_STORE.values()))
+    m.set("bot_users", (), len(USERS))
+    m.set("bot_alerts_active", (), len(ALERTS))
+    m.set("bot_uptime_seconds", (), time.time() - m.started)
+
+
+METRICS.collectors.append(_collect_runtime)
+
+
+def instrument_handlers(app: Application) -> None:
+    """Bọc callback của mọi handler đã đăng ký để đo latency / lỗi / in-flight"""
+    for group in app.handlers.values():
+        for handler in group:
+            callback = handler.callback
+            if getattr(callback, "_instrumented", False):
+                continue
+            commands = getattr(handler, "commands", None)
+            name = f"/{sorted(commands)[0]}" if commands else callback.__name__
+            handler.callback = _instrumented(callback, (("handler", name),))
+
+
+def _instrumented(callback, labels: Labels):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with METRICS.timer("bot_handler", labels):
+            return await callback(update, context)
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+async def start_metrics_server() -> Optional[Any]:
+    """Endpoint Prometheus /metrics chỉ nghe trên 127.0.0.1"""
+    if not METRICS_PORT:
+        return None
+    from aiohttp import web
+
+    async def metrics_view(request):
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    except OSError as e:
+        logger.warning("Không mở được cổng metrics %d: %s", METRICS_PORT, e)
+        await runner.cleanup()
+        return None
+    logger.info("📈 Metrics tại http://127.0.0.1:%d/metrics", METRICS_PORT)
+    return runner
+
+
+def _hit_ratio(cache: str) -> str:
+    series = {dict(lb)["result"]: v for lb, v in METRICS.counters.get("bot_cache_requests_total", {}).items() if dict(lb)["cache"] == cache}
+    total = sum(series.values())
+    hits = total - series.get("miss", 0)
+    return f"{hits / total:.0%} ({int(total)} lượt)" if total else "chưa có"
+
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("🚫 Không có quyền.")
+        return
+    METRICS.render()  # chạy collectors
+    uptime = time.time() - METRICS.started
+    msg = f"📈 <b>THỐNG KÊ BOT</b> (uptime {int(uptime // 3600)}h{int(uptime % 3600 // 60):02d}m)\n\n"
+    msg += "<b>Lệnh</b> (số lượt · p50 · p95 · lỗi)\n"
+    errors = METRICS.counters.get("bot_handler_errors_total", {})
+    for lb, h in sorted(METRICS.histograms.get("bot_handler_latency_seconds", {}).items()):
+        msg += (f"• {pyhtml.escape(dict(lb)['handler'])}: {int(Metrics.count(h))} · {Metrics.quantile(h, 0.5):g}s"
+                f" · {Metrics.quantile(h, 0.95):g}s · {int(errors.get(lb, 0))}\n")
+    msg += "\n<b>Upstream</b> (số lượt · p95 · lỗi)\n"
+    errors = METRICS.counters.get("bot_upstream_errors_total", {})
+    for lb, h in sorted(METRICS.histograms.get("bot_upstream_latency_seconds", {}).items()):
+        msg += f"• {dict(lb)['host']}: {int(Metrics.count(h))} · {Metrics.quantile(h, 0.95):g}s · {int(errors.get(lb, 0))}\n"
+    msg += "\n<b>Cache</b>\n"
+    for cache in ("quote", "report", "ai", "digest"):
+        msg += f"• {cache}: {_hit_ratio(cache)}\n"
+    last = COIN_CACHE["last_update"]
+    msg += f"• coin index: {len(COIN_CACHE['index'] or ())} coin, cập nhật {format_age(time.time() - last) if last else 'chưa'}\n"
+    msg += f"• CoinGecko: {COINGECKO.stats['calls']} call, circuit {'MỞ' if COINGECKO.is_open else 'đóng'}\n"
+    msg += f"• alert: {len(ALERTS)} đang theo dõi trên {len(ALERTS.coins())} coin\n"
+    if COORD.path:
+        msg += f"• replica: {REPLICA_ID} ({'leader' if COORD.is_leader else 'follower'})\n"
+    if LAST_BROADCAST:
+        b = LAST_BROADCAST
+        msg += f"\n<b>Broadcast</b> {b['id']}: gửi {b['sent']}, lỗi {b['failed']}, {b['sent'] / max(b['elapsed'], 1e-6):.1f} tin/s\n"
+    await update.message.reply_text(msg, parse_mode="HTML")
 
 
 # ===== REGISTER HANDLERS =====
@@ -529,9 +3943,17 @@ application.add_handler(CommandHandler("delnews", delnews))
 application.add_handler(CommandHandler("listnews", listnews))
 application.add_handler(CommandHandler("price", price))
 application.add_handler(CommandHandler("top", top))
+application.add_handler(CommandHandler("alert", alert_cmd))
+application.add_handler(CommandHandler("alerts", alerts_cmd))
+application.add_handler(CommandHandler("delalert", delalert))
+application.add_handler(CommandHandler("chart", chart))
 application.add_handler(CommandHandler("report", report_cmd))
 application.add_handler(CommandHandler("settime", settime))
+application.add_handler(CommandHandler("mytime", mytime))
+application.add_handler(CommandHandler("stats", stats_cmd))
+application.add_handler(InlineQueryHandler(inline_query))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ai_chat))
+instrument_handlers(application)
 
 
 # ===== ERROR HANDLER (logging) =====
@@ -549,46 +3971,179 @@ application.add_error_handler(error_handler)
 
 
 # ===== STARTUP / MAIN =====
-async def send_daily_report_task(app: Application):
-    """Tác vụ chạy nền gửi báo cáo hàng ngày"""
-    await asyncio.sleep(5)
-    while True:
-        cfg = load_config()
-        h, m = map(int, cfg.get("report_time", "08:00").split(":"))
-        now = datetime.now()
-        report_dt = datetime.combine(now.date(), dt_time(hour=h, minute=m))
-        if now > report_dt:
-            report_dt += timedelta(days=1)
-        await asyncio.sleep((report_dt - now).total_seconds())
+BACKGROUND_TASKS: List[asyncio.Task] = []
+METRICS_RUNNER: Dict[str, Any] = {"runner": None}
 
+
+async def post_init(app: Application):
+    """Chạy sau khi Application khởi tạo"""
+    # aiohttp nạp trong thread, song song với phần còn lại; chưa task nào dùng tới nó
+    http_import = asyncio.create_task(
+        asyncio.to_thread(importlib.import_module, "aiohttp.web" if METRICS_PORT else "aiohttp.client")
+    )
+    await asyncio.to_thread(ALERTS.load)
+    if not WEBHOOK_URL:
         try:
-            msg = await generate_report_msg()
-            if GROUP_ID:
-                await app.bot.send_message(
-                    int(GROUP_ID), msg, parse_mode="HTML", disable_web_page_preview=True
-                )
-            for uid in cfg.get("users", {}):
-                await app.bot.send_message(
-                    int(uid), msg, parse_mode="HTML", disable_web_page_preview=True
-                )
+            await app.bot.delete_webhook(drop_pending_updates=True)
+            logger.info("🧹 Đã xóa webhook cũ, chuyển sang polling.")
         except Exception as e:
-            logger.error(f"⚠️ Lỗi gửi báo cáo: {e}")
+            logger.warning(f"Lỗi xóa webhook: {e}")
+    await http_import
+    await load_snapshots()
+    await COORD.pull()  # replica phụ: cache leader vừa ghi mới hơn snapshot
+    # chỉ chạy trên leader (luôn là instance này nếu không đặt COORD_DB)
+    COORD.jobs = [SCHEDULER.run, feed_poller_task, coin_index_task, alert_task, history_task]
+    BACKGROUND_TASKS.append(asyncio.create_task(COORD.run(app)))
+    METRICS_RUNNER["runner"] = await start_metrics_server()
 
 
-async def post_init(app: Application):
-    """Chạy sau khi Application khởi tạo"""
-    asyncio.create_task(send_daily_report_task(app))
+async def post_shutdown(app: Application):
+    """Đóng các tài nguyên dùng chung khi bot dừng"""
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    BACKGROUND_TASKS.clear()
+    await COORD.stop()
+    await CONFIG.flush()
+    await ALERTS.flush()
+    HISTORY.close()
+    USERS.close()
+    if METRICS_RUNNER["runner"] is not None:
+        await METRICS_RUNNER["runner"].cleanup()
+    await close_session()
+
+
+application.post_init = post_init
+application.post_shutdown = post_shutdown
+
+
+# ===== WEBHOOK (ASGI / HYPERCORN) =====
+# Telegram POST update vào WEBHOOK_PATH; update được đưa vào update_queue của PTB
+# và xử lý song song (tối đa UPDATE_CONCURRENCY). Hàng đợi đầy -> 503 để Telegram gửi lại sau.
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_MAX_QUEUE = 1000
+WEBHOOK_MAX_BODY = 1024 * 1024
+STARTED_AT = time.time()
+
+
+def webhook_secret() -> str:
+    """Secret token cố định theo BOT_TOKEN nếu không cấu hình WEBHOOK_SECRET"""
+    return WEBHOOK_SECRET or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
+
+async def _asgi_respond(send, status: int, body: Any = b"", content_type: bytes = b"text/plain") -> None:
+    if not isinstance(body, bytes):
+        body, content_type = json.dumps(body).encode(), b"application/json"
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type)]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _asgi_read_body(receive) -> Optional[bytes]:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > WEBHOOK_MAX_BODY:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    path, method = scope["path"], scope["method"]
+    if path == "/healthz" and method in ("GET", "HEAD"):
+        await _asgi_respond(send, 200, {
+            "ok": application.running,
+            "queue": application.update_queue.qsize(),
+            "uptime": round(time.time() - STARTED_AT),
+            "replica": REPLICA_ID,
+            "leader": COORD.is_leader,
+        })
+        return
+    if path != WEBHOOK_PATH or method != "POST":
+        await _asgi_respond(send, 404, b"not found")
+        return
+    headers = dict(scope["headers"])
+    token = headers.get(b"x-telegram-bot-api-secret-token", b"")
+    if not hmac.compare_digest(token, webhook_secret().encode()):
+        await _asgi_respond(send, 403, b"forbidden")
+        return
+    if application.update_queue.qsize() >= WEBHOOK_MAX_QUEUE:
+        await _asgi_respond(send, 503, b"busy")
+        return
+    body = await _asgi_read_body(receive)
+    if body is None:
+        await _asgi_respond(send, 413, b"too large")
+        return
     try:
-        await app.bot.delete_webhook(drop_pending_updates=True)
-        logger.info("🧹 Đã xóa webhook cũ, chuyển sang polling.")
+        update = Update.de_json(json.loads(body), application.bot)
     except Exception as e:
-        logger.warning(f"Lỗi xóa webhook: {e}")
+        logger.warning("Webhook update không hợp lệ: %s", e)
+        await _asgi_respond(send, 400, b"bad request")
+        return
+    await application.update_queue.put(update)
+    await _asgi_respond(send, 200, b"ok")
 
 
-application.post_init = post_init
+async def run_webhook() -> None:
+    """Chạy PTB + Hypercorn trên cùng event loop (thay cho run_polling)"""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config as HypercornConfig
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=webhook_secret(),
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=min(100, max(1, UPDATE_CONCURRENCY)),
+    )
+    await application.start()
+    hc = HypercornConfig()
+    hc.bind = [f"0.0.0.0:{PORT}"]
+    if COORD_DB and hasattr(socket, "SO_REUSEPORT"):
+        # nhiều replica trên cùng máy nghe chung PORT, kernel chia kết nối
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("0.0.0.0", PORT))
+        hc.bind = [f"fd://{sock.fileno()}"]
+    hc.accesslog = None
+    try:
+        await serve(asgi_app, hc, shutdown_trigger=stop.wait)
+    finally:
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
 
 
 if __name__ == "__main__":
-    logger.info("🤖 Bot đang chạy bằng polling...")
-    application.run_polling(stop_signals=None)
+    if WEBHOOK_URL:
+        logger.info("🤖 Bot đang chạy bằng webhook (cổng %d)...", PORT)
+        asyncio.run(run_webhook())
+    else:
+        if COORD_DB:
+            # getUpdates chỉ cho một consumer: replica khác đứng chờ làm dự phòng
+            logger.info("⏳ %s chờ quyền leader để polling...", REPLICA_ID)
+            while not COORD.try_lease():
+                time.sleep(LEASE_RENEW)
+            COORD.on_lost = application.stop_running
+        logger.info("🤖 Bot đang chạy bằng polling...")
+        application.run_polling(stop_signals=None)
 